@@ -1,160 +1,269 @@
 import streamlit as st
 import pandas as pd
-import numpy as np
+import io
 import re
+import time
+import uuid
+
+from footing_groups import calculate_group_resultants
+from load_combination import (
+    CACHE_BUDGET_MB, INPUT_TYPES, JOB_WORKERS, MEMBER_VALUE_COLS, OUTPUT_FORMATS, STANDARD_COMBINATION_SET,
+    STORE_BUDGET_MB, STORE_DIR, CaseMatrixStore, JobManager, Profiler, ResultCache, ResultIndex, calculate_combinations,
+    calculate_governing_combinations, calculate_incremental_combinations, calculate_reaction_combinations,
+    calculate_underground_combinations, compile_combination_rules, count_revision_changes, diff_case_matrices,
+    enable_stage_logging, format_read_stats, get_output_file_name, get_required_cols, hash_file, load_case_matrix,
+    read_table_columns, report_revision_changes, serialize_result,
+)
 
-# --- ส่วนของการคำนวณ (โหมด Column และ Wall) ---
-def calculate_combinations(df_input, custom_story_name=None, mode='Column'):
-    df = df_input.copy()
-    # สำหรับโหมด Column/Wall จะใช้ P, V2, V3, ...
-    value_cols = ['P', 'V2', 'V3', 'T', 'M2', 'M3']
-    
-    if mode == 'Column':
-        group_cols = ['Story', 'Column', 'Unique Name', 'Station']
-    else: # Wall
-        group_cols = ['Story', 'Pier', 'Location']
-    
-    if custom_story_name:
-        df['Story'] = custom_story_name
-        
-    pivot_df = df.pivot_table(index=group_cols, columns='Output Case', values=value_cols, fill_value=0)
-    pivot_df.columns = ['_'.join(map(str, col)).strip() for col in pivot_df.columns.values]
-    pivot_df.reset_index(inplace=True)
-
-    required_cases = ['Dead', 'SDL', 'Live', 'EX', 'EY']
-    for case in required_cases:
-        for val in value_cols:
-            col_name = f'{val}_{case}'
-            if col_name not in pivot_df.columns:
-                pivot_df[col_name] = 0
-
-    combo_dfs = {}
-    combinations = {
-        'U01': {'Dead': 1.4, 'SDL': 1.4, 'Live': 1.7}, 'U02': {'Dead': 1.05, 'SDL': 1.05, 'Live': 1.275, 'EX': 1},
-        'U03': {'Dead': 1.05, 'SDL': 1.05, 'Live': 1.275, 'EX': -1}, 'U04': {'Dead': 1.05, 'SDL': 1.05, 'Live': 1.275, 'EY': 1},
-        'U05': {'Dead': 1.05, 'SDL': 1.05, 'Live': 1.275, 'EY': -1}, 'U06': {'Dead': 0.9, 'SDL': 0.9, 'EX': 1},
-        'U07': {'Dead': 0.9, 'SDL': 0.9, 'EX': -1}, 'U08': {'Dead': 0.9, 'SDL': 0.9, 'EY': 1},
-        'U09': {'Dead': 0.9, 'SDL': 0.9, 'EY': -1},
-    }
-
-    for name, factors in combinations.items():
-        formula_parts = []
-        ordered_cases = ['Dead', 'SDL', 'Live', 'EX', 'EY']
-        for case in ordered_cases:
-            factor_val = factors.get(case)
-            if factor_val:
-                formula_parts.append(f"{factor_val:+g}{case}")
-        formula_string = "".join(formula_parts).lstrip('+')
-        full_formula_name = f"{name}: {formula_string}"
-        
-        temp_df = pivot_df[group_cols].copy()
-        temp_df['Output Case'] = full_formula_name
-        
-        for val_col in value_cols:
-            p_dead = pivot_df.get(f'{val_col}_Dead', pd.Series(0, index=pivot_df.index))
-            p_sdl = pivot_df.get(f'{val_col}_SDL', pd.Series(0, index=pivot_df.index))
-            p_live = pivot_df.get(f'{val_col}_Live', pd.Series(0, index=pivot_df.index))
-            p_ex = pivot_df.get(f'{val_col}_EX', pd.Series(0, index=pivot_df.index))
-            p_ey = pivot_df.get(f'{val_col}_EY', pd.Series(0, index=pivot_df.index))
-            
-            f_dead = factors.get('Dead', 0); f_sdl = factors.get('SDL', 0); f_live = factors.get('Live', 0)
-            f_ex = factors.get('EX', 0); f_ey = factors.get('EY', 0)
-            
-            # เงื่อนไขพิเศษสำหรับ V2, V3
-            if val_col in ['V2', 'V3']:
-                f_ex *= 2.5; f_ey *= 2.5
-            
-            total_val = (p_dead * f_dead) + (p_sdl * f_sdl) + (p_live * f_live) + (p_ex * f_ex) + (p_ey * f_ey)
-            temp_df[val_col] = total_val
-        combo_dfs[name] = temp_df
-
-    result_df = pd.concat(combo_dfs.values(), ignore_index=True)
-    result_df[value_cols] = result_df[value_cols].round(4)
-    final_cols = group_cols + ['Output Case'] + value_cols
-    return result_df[final_cols]
-
-# --- <<<<<<<<<<<<<<<<<<<< ฟังก์ชันใหม่สำหรับ Mode Reaction <<<<<<<<<<<<<<<<<<<< ---
-def calculate_reaction_combinations(df_load, df_coords, pre_combo_factors):
-    df = df_load.copy()
-    
-    # สำหรับโหมด Reaction จะใช้ FX, FY, FZ, ...
-    value_cols = ['FX', 'FY', 'FZ', 'MX', 'MY', 'MZ']
-    group_cols = ['Story', 'Unique Name']
-
-    # --- ขั้นตอนที่ 1: คูณค่าด้วย Factor ที่ผู้ใช้กรอกเข้ามาก่อน ---
-    factor_cols = ['FZ', 'MX', 'MY', 'MZ']
-    for case, factor in pre_combo_factors.items():
-        if factor != 1.0: # ทำเฉพาะเมื่อ factor ไม่ใช่ 1 เพื่อประสิทธิภาพ
-            mask = df['Output Case'] == case
-            df.loc[mask, factor_cols] = df.loc[mask, factor_cols] * factor
-
-    # --- ขั้นตอนที่ 2: Pivot Table ---
-    pivot_df = df.pivot_table(index=group_cols, columns='Output Case', values=value_cols, fill_value=0)
-    pivot_df.columns = ['_'.join(map(str, col)).strip() for col in pivot_df.columns.values]
-    pivot_df.reset_index(inplace=True)
-
-    required_cases = ['Dead', 'SDL', 'Live', 'EX', 'EY']
-    for case in required_cases:
-        for val in value_cols:
-            col_name = f'{val}_{case}'
-            if col_name not in pivot_df.columns:
-                pivot_df[col_name] = 0
-
-    # --- ขั้นตอนที่ 3: คำนวณ Load Combinations ---
-    combo_dfs = {}
-    combinations = {
-        'U01': {'Dead': 1.4, 'SDL': 1.4, 'Live': 1.7}, 'U02': {'Dead': 1.05, 'SDL': 1.05, 'Live': 1.275, 'EX': 1},
-        'U03': {'Dead': 1.05, 'SDL': 1.05, 'Live': 1.275, 'EX': -1}, 'U04': {'Dead': 1.05, 'SDL': 1.05, 'Live': 1.275, 'EY': 1},
-        'U05': {'Dead': 1.05, 'SDL': 1.05, 'Live': 1.275, 'EY': -1}, 'U06': {'Dead': 0.9, 'SDL': 0.9, 'EX': 1},
-        'U07': {'Dead': 0.9, 'SDL': 0.9, 'EX': -1}, 'U08': {'Dead': 0.9, 'SDL': 0.9, 'EY': 1},
-        'U09': {'Dead': 0.9, 'SDL': 0.9, 'EY': -1},
-    }
-
-    for name, factors in combinations.items():
-        formula_parts = []
-        ordered_cases = ['Dead', 'SDL', 'Live', 'EX', 'EY']
-        for case in ordered_cases:
-            factor_val = factors.get(case)
-            if factor_val:
-                formula_parts.append(f"{factor_val:+g}{case}")
-        formula_string = "".join(formula_parts).lstrip('+')
-        full_formula_name = f"{name}: {formula_string}"
-        
-        temp_df = pivot_df[group_cols].copy()
-        temp_df['Output Case'] = full_formula_name
-        
-        for val_col in value_cols:
-            v_dead = pivot_df.get(f'{val_col}_Dead', pd.Series(0, index=pivot_df.index))
-            v_sdl = pivot_df.get(f'{val_col}_SDL', pd.Series(0, index=pivot_df.index))
-            v_live = pivot_df.get(f'{val_col}_Live', pd.Series(0, index=pivot_df.index))
-            v_ex = pivot_df.get(f'{val_col}_EX', pd.Series(0, index=pivot_df.index))
-            v_ey = pivot_df.get(f'{val_col}_EY', pd.Series(0, index=pivot_df.index))
-            
-            f_dead = factors.get('Dead', 0); f_sdl = factors.get('SDL', 0); f_live = factors.get('Live', 0)
-            f_ex = factors.get('EX', 0); f_ey = factors.get('EY', 0)
-            
-            # --- เงื่อนไขพิเศษสำหรับ FX, FY ---
-            if val_col in ['FX', 'FY']:
-                f_ex *= 2.5; f_ey *= 2.5
-            
-            total_val = (v_dead * f_dead) + (v_sdl * f_sdl) + (v_live * f_live) + (v_ex * f_ex) + (v_ey * f_ey)
-            temp_df[val_col] = total_val
-        combo_dfs[name] = temp_df
 
-    result_df = pd.concat(combo_dfs.values(), ignore_index=True)
+# --- แคชที่ใช้ร่วมกันทุก Session ของเซิร์ฟเวอร์ ---
+@st.cache_resource
+def get_result_cache():
+    return ResultCache(int(CACHE_BUDGET_MB * 1024 ** 2))
 
-    # --- ขั้นตอนที่ 4: รวมผลลัพธ์กับไฟล์พิกัด ---
-    df_coords.rename(columns={'UniqueName': 'Unique Name'}, inplace=True, errors='ignore')
-    coords_to_merge = df_coords[['Unique Name', 'X', 'Y', 'Z']].drop_duplicates(subset=['Unique Name'])
-    
-    final_df = pd.merge(result_df, coords_to_merge, on='Unique Name', how='left')
 
-    # --- ขั้นตอนที่ 5: จัดเรียงและจัดรูปแบบผลลัพธ์ ---
-    final_df[value_cols] = final_df[value_cols].round(4)
-    # จัดเรียงคอลัมน์ใหม่เพื่อให้ดูง่าย
-    final_cols = ['Story', 'Unique Name', 'X', 'Y', 'Z', 'Output Case'] + value_cols
-    return final_df[final_cols]
-# --- <<<<<<<<<<<<<<<<<<<< สิ้นสุดฟังก์ชันใหม่ <<<<<<<<<<<<<<<<<<<< ---
+@st.cache_resource
+def get_job_manager():
+    return JobManager(JOB_WORKERS)
+
+
+@st.cache_resource
+def get_model_store():
+    return CaseMatrixStore(STORE_DIR, int(STORE_BUDGET_MB * 1024 ** 2)) if STORE_DIR else None
+
+
+def format_model_source(model_info):
+    if model_info['stored']:
+        return "📂 เปิดจากคลังโมเดลบนดิสก์ (ไม่ต้องอ่านและ pivot ไฟล์ใหม่) | " + format_read_stats(model_info['read_stats'])
+    return format_read_stats(model_info['read_stats'])
+
+
+@st.cache_resource
+def get_combination_set(x_cases, y_cases, orthogonal, sign_flips, amplifier):
+    # คอมไพล์ชุด Combination ครั้งเดียวต่อชุดกฎ แล้วใช้เทนเซอร์สัมประสิทธิ์ซ้ำทุกครั้งที่หน้าเว็บรันซ้ำ
+    return compile_combination_rules({
+        'directions': {'X': list(x_cases), 'Y': list(y_cases)},
+        'orthogonal': orthogonal,
+        'sign_flips': sign_flips,
+        'amplifier': {col: amplifier for col in ['V2', 'V3', 'FX', 'FY']},
+    })
+
+
+def get_upload_hash(uploaded_file):
+    # แฮชไฟล์ครั้งเดียวต่อไฟล์ที่อัปโหลด ไม่ต้องอ่านไฟล์ใหม่ทุกครั้งที่หน้าเว็บรันซ้ำ
+    upload_hashes = st.session_state.setdefault('upload_hashes', {})
+    file_id = getattr(uploaded_file, 'file_id', None) or (uploaded_file.name, uploaded_file.size)
+    if file_id not in upload_hashes:
+        upload_hashes[file_id] = hash_file(uploaded_file)
+    return upload_hashes[file_id]
+
+
+def copy_upload(uploaded_file):
+    # งานเบื้องหลังอ่านจากสำเนาของไฟล์ ตำแหน่งอ่านไฟล์จึงไม่ชนกับการรันหน้าเว็บรอบถัดไป
+    snapshot = io.BytesIO(uploaded_file.getvalue())
+    snapshot.name = uploaded_file.name
+    return snapshot
+
+
+# --- ผลลัพธ์ที่ Session ถือไว้เอง: ค่าล่าสุดของแต่ละช่อง (slot) ไม่ต้องคำนวณใหม่แม้ใหญ่เกินแคชร่วมหรือถูกลบออกจากแคช ---
+def get_result(key, slot=None):
+    held = st.session_state.setdefault('held_results', {}).get(slot or key[0])
+    if held is not None and held[0] == key:
+        return held[1]
+    return get_result_cache().get(key)
+
+
+def hold_result(key, value, slot=None):
+    if value is not None:
+        st.session_state.setdefault('held_results', {})[slot or key[0]] = (key, value)
+    return value
+
+
+def get_or_compute_result(key, compute, profiler, slot=None):
+    value = get_result(key, slot)
+    if value is None:
+        value = get_result_cache().get_or_compute(key, compute, profiler=profiler)
+    else:
+        with profiler.stage('cache hit', pipeline=str(key[0])):
+            pass
+    return hold_result(key, value, slot)
+
+
+# --- งานคำนวณเบื้องหลัง: หน้าเว็บไม่ค้างระหว่างคำนวณ แสดงความคืบหน้าและยกเลิกได้ ---
+def get_session_id():
+    return st.session_state.setdefault('session_id', uuid.uuid4().hex)
+
+
+def format_job_progress(job):
+    if job.status == 'queued':
+        return f"รอคิว ({time.time() - job.created:,.0f} วินาที)"
+    detail = f"{job.done:,} / {job.total:,}" if job.total else f"{job.done:,}"
+    return f"{job.stage}: {detail} | {time.time() - job.started:,.0f} วินาที"
+
+
+@st.fragment(run_every=1.0)
+def show_job_progress(job, label):
+    # อัปเดตเฉพาะส่วนนี้ทุกวินาที เมื่องานจบจึงรันทั้งหน้าใหม่เพื่อแสดงผลลัพธ์
+    if not job.is_active:
+        st.rerun()
+    fraction = min(job.done / job.total, 1.0) if job.total else 0.0
+    st.progress(fraction, text=f"⏳ {label}: {format_job_progress(job)}")
+    if st.button("ยกเลิก", key=f"cancel_job_{job.id}"):
+        get_job_manager().cancel(job, get_session_id())
+        st.session_state.setdefault('cancelled_jobs', set()).add(job.key)
+        st.rerun()
+
+
+def run_in_background(key, compute, label, profiler):
+    # คืนผลลัพธ์เมื่อคำนวณเสร็จ หรือ None ระหว่างที่งานยังไม่เสร็จ (แสดงแถบความคืบหน้าแทน)
+    # compute(job_profiler) ทำงานในเธรดเบื้องหลัง ห้ามเรียกคำสั่ง st.* ภายใน
+    result_cache, job_manager = get_result_cache(), get_job_manager()
+    session_id = get_session_id()
+    job = job_manager.get(key)
+    merged_jobs = st.session_state.setdefault('merged_jobs', set())
+    if job is not None and job.status == 'done' and (session_id, job.id) not in merged_jobs:
+        # บันทึกขั้นตอนของงานเบื้องหลังรวมในแผง Diagnostics ของการรันที่ได้ผลลัพธ์
+        merged_jobs.add((session_id, job.id))
+        profiler.records.extend(job.profiler.records)
+    value = get_result(key)
+    if value is not None:
+        with profiler.stage('cache hit', pipeline=str(key[0])):
+            pass
+        return hold_result(key, value)
+    if job is not None and job.status == 'done':
+        # ผลที่ใหญ่เกินแคชร่วมรออยู่ในงาน Session รับไปถือไว้เอง
+        value = job_manager.take_result(job, session_id)
+        if value is not None:
+            return hold_result(key, value)
+
+    cancelled_jobs = st.session_state.setdefault('cancelled_jobs', set())
+    if key in cancelled_jobs:
+        st.warning(f"⏹️ ยกเลิก{label}แล้ว")
+        if st.button("คำนวณใหม่", key=f"restart_job_{abs(hash(key))}"):
+            cancelled_jobs.discard(key)
+            st.rerun()
+        return None
+
+    def compute_into_cache(job_profiler):
+        # ผลที่เก็บในแคชได้ไม่ต้องค้างอยู่ในงาน ผลที่ใหญ่เกินแคชคืนให้งานถือไว้จนกว่า Session จะรับไป
+        value = result_cache.put(key, compute(job_profiler))
+        return None if key in result_cache else value
+
+    # งานที่ล้มเหลวหรือถูกยกเลิกจะไม่ถูกส่งซ้ำอัตโนมัติ (ไม่เช่นนั้นทุกการรันจะเริ่มงานใหม่)
+    if job is not None and job.status == 'failed':
+        job_manager.forget(job)
+        raise RuntimeError(job.error)
+    if job is not None and job.status == 'cancelled':
+        job_manager.forget(job)
+        cancelled_jobs.add(key)
+        st.rerun()
+    job = job_manager.submit(
+        key, compute_into_cache, owner=session_id, label=label, profile=profiler.enabled, context=profiler.context,
+    )
+    show_job_progress(job, label)
+    return None
+
+
+# --- ตารางผลลัพธ์แบบแบ่งหน้า: ส่งไปยังเบราว์เซอร์เฉพาะหน้าที่เลือก ตารางเต็มและดัชนีอยู่ในแคชฝั่งเซิร์ฟเวอร์ ---
+RESULT_PAGE_SIZES = [100, 500, 1000, 5000]
+SELECT_FILTER_COLS = ['Story', 'Output Case', 'Metric', 'Change']
+
+
+def show_result_table(df, view_key, widget_key, profiler):
+    index = get_or_compute_result(
+        ('index',) + tuple(view_key), lambda: ResultIndex(df), profiler, slot=('index', widget_key)
+    )
+    # ตัวกรองผูกกับผลลัพธ์ชุดนี้ เมื่อผลลัพธ์เปลี่ยนตัวกรองจะเริ่มใหม่
+    widget_key = f"{widget_key}_{abs(hash(tuple(view_key)))}"
+    filters = {}
+    for col, container in zip(index.index_cols, st.columns(max(len(index.index_cols), 1))):
+        with container:
+            if col in SELECT_FILTER_COLS:
+                filters[col] = st.multiselect(col, index.values[col], key=f"{widget_key}_{col}")
+            else:
+                text = st.text_input(f"{col} (คั่นด้วย ,)", key=f"{widget_key}_{col}")
+                filters[col] = [value.strip() for value in text.split(',') if value.strip()]
+
+    n_rows = index.count(filters)
+    p_col1, p_col2 = st.columns(2)
+    with p_col1:
+        page_size = st.selectbox("แถวต่อหน้า", RESULT_PAGE_SIZES, index=1, key=f"{widget_key}_page_size")
+    n_pages = max(1, -(-n_rows // page_size))
+    with p_col2:
+        page = st.number_input(f"หน้า (ทั้งหมด {n_pages:,} หน้า)", min_value=1, value=1, step=1, key=f"{widget_key}_page")
+    page = min(int(page), n_pages)
+
+    start, end = (page - 1) * page_size, min(page * page_size, n_rows)
+    summary = " | ".join(f"{col}: {count:,}" for col, count in index.summary(filters).items())
+    st.caption(
+        f"แถว {min(start + 1, n_rows):,}–{end:,} จาก {n_rows:,} แถวที่ตรงเงื่อนไข (ทั้งหมด {len(index):,} แถว)"
+        + (f" | {summary}" if summary else "")
+    )
+    with profiler.stage('render', pipeline='view', rows_in=n_rows) as record:
+        page_df = index.page(filters, page - 1, page_size)
+        st.dataframe(page_df, hide_index=True)
+        record['rows_out'] = len(page_df)
+
+
+# --- Revision ก่อนหน้า: ใช้ผลลัพธ์เดิมซ้ำ และคำนวณใหม่เฉพาะชิ้นส่วนที่เพิ่ม/ลบ/เปลี่ยน ---
+REVISION_LABELS = {'added': 'เพิ่ม', 'removed': 'ลบ', 'changed': 'เปลี่ยน', 'unchanged': 'ไม่เปลี่ยน'}
+
+
+def track_revision(mode, upload_key, file_name, make_key, df_coords=None):
+    # จำไฟล์ล่าสุดของแต่ละโหมด เมื่ออัปโหลดไฟล์ใหม่ ไฟล์เดิมจะกลายเป็น Revision ก่อนหน้า
+    # ติดตามด้วยแฮชของไฟล์เท่านั้น การเปลี่ยนตัวเลือก (float32, ชุด Combination) จึงไม่ทำให้ไฟล์ก่อนหน้าหายไป
+    revisions = st.session_state.setdefault('revisions', {})
+    current = revisions.get(mode)
+    if current is None or current['upload'] != upload_key:
+        previous = dict(current, previous=None) if current is not None else None
+        current = {'upload': upload_key, 'name': file_name, 'coords': df_coords, 'previous': previous}
+        revisions[mode] = current
+    if current['previous'] is None:
+        return None
+    # คีย์ของไฟล์ก่อนหน้าสร้างจากตัวเลือกปัจจุบัน ถ้าไฟล์นั้นไม่เคยอ่านด้วยตัวเลือกนี้จะไม่พบเมทริกซ์และไม่เทียบ
+    return dict(current['previous'], key=make_key(current['previous']['upload']))
+
+
+def get_previous_matrix(model_key):
+    # เมทริกซ์ของ Revision ก่อนหน้าจากแคช หรือคลังโมเดลบนดิสก์ (None ถ้าถูกลบไปแล้ว)
+    model = get_result_cache().get(('model',) + model_key)
+    if model is None and get_model_store() is not None:
+        model = get_model_store().get(('matrix',) + model_key)
+    return None if model is None else model[0]
+
+
+def get_revision_diff(previous, revision_key, old_matrix, new_matrix, mode, df_coords, profiler):
+    return get_result_cache().get_or_compute(
+        ('diff',) + previous['key'] + revision_key,
+        lambda: diff_case_matrices(
+            old_matrix, new_matrix, mode, old_coords=previous['coords'], new_coords=df_coords, profiler=profiler
+        ),
+        profiler=profiler,
+    )
+
+
+def show_revision_changes(previous, revision_key, old_matrix, new_matrix, mode, profiler, pre_combo_factors=None,
+                          df_coords=None, combination_set=STANDARD_COMBINATION_SET, incremental=False):
+    st.write(f"เทียบกับไฟล์ก่อนหน้า **{previous['name']}**: ค่า Demand ที่ควบคุมของชิ้นส่วนที่เพิ่ม ลบ หรือเปลี่ยน")
+    if incremental:
+        st.caption("ผลลัพธ์ Load Combination ใช้ผลของไฟล์ก่อนหน้าซ้ำ และคำนวณใหม่เฉพาะชิ้นส่วนที่เพิ่มหรือเปลี่ยน")
+
+    def compute_report(job_profiler):
+        diff_df = get_revision_diff(previous, revision_key, old_matrix, new_matrix, mode, df_coords, job_profiler)
+        report_df = report_revision_changes(
+            diff_df, old_matrix, new_matrix, mode=mode, pre_combo_factors=pre_combo_factors, profiler=job_profiler,
+            combination_set=combination_set,
+        )
+        return report_df, count_revision_changes(diff_df)
+
+    factors_key = tuple(pre_combo_factors.items()) if pre_combo_factors else ()
+    report_key = ('revision',) + previous['key'] + revision_key + (factors_key, combination_set.key)
+    report = run_in_background(report_key, compute_report, "การเปรียบเทียบ Revision", profiler)
+    if report is None:
+        return
+    report_df, counts = report
+    st.caption(" | ".join(f"{REVISION_LABELS[change]}: {count:,}" for change, count in counts.items()))
+    show_result_table(report_df, report_key, 'revision_view', profiler)
 
 
 # --- ส่วนของหน้าเว็บ Streamlit ---
@@ -168,6 +277,78 @@ mode = st.radio(
     horizontal=True,
     help="เลือก 'Column' หรือ 'Wall' สำหรับการคำนวณแรงในชิ้นส่วน | เลือก 'Reaction' สำหรับการคำนวณแรงปฏิกิริยาที่ฐานราก"
 )
+output_format = st.radio(
+    "รูปแบบผลลัพธ์:",
+    ('ทุก Combination', 'Envelope (Max/Min)'),
+    horizontal=True,
+    help="'Envelope' จะแสดงค่า Max/Min ของแต่ละแรงและชื่อ Combination ที่ควบคุม 1 แถวต่อชิ้นส่วน (ใช้หน่วยความจำน้อยกว่ามาก)"
+)
+envelope = output_format.startswith('Envelope')
+result_cache = get_result_cache()
+downcast = st.checkbox(
+    "ลดขนาดตัวเลขเป็น float32 ระหว่างอ่านไฟล์",
+    help="ช่วยให้ไฟล์ ETABS ขนาดหลาย GB ใช้หน่วยความจำประมาณครึ่งหนึ่ง (ความละเอียดทศนิยมลดลงเล็กน้อย)"
+)
+download_labels = {'csv': 'CSV', 'csv.gz': 'CSV (gzip)', 'zip': 'CSV (zip)', 'parquet': 'Parquet', 'feather': 'Feather (Arrow)'}
+download_format = st.selectbox(
+    "รูปแบบไฟล์ดาวน์โหลด:",
+    list(OUTPUT_FORMATS),
+    format_func=download_labels.get,
+    help="ไฟล์บีบอัดหรือ Parquet/Feather มีขนาดเล็กกว่าและดาวน์โหลดได้เร็วกว่า CSV มากสำหรับผลลัพธ์ขนาดใหญ่"
+)
+download_mime = OUTPUT_FORMATS[download_format][1]
+combination_source = st.radio(
+    "ชุด Load Combination:",
+    ('U01-U09 (มาตรฐาน)', 'สร้างจากกฎแผ่นดินไหว (100/30, แรงเยื้องศูนย์)'),
+    horizontal=True,
+    help="สร้างชุด Combination จากทิศทางแผ่นดินไหว กฎ 100/30 และ Load Case แรงเยื้องศูนย์ แล้วคำนวณทุกชุดพร้อมกันด้วยเมทริกซ์เดียว"
+)
+combination_set = STANDARD_COMBINATION_SET
+if combination_source != 'U01-U09 (มาตรฐาน)':
+    with st.expander("กำหนดกฎการสร้าง Combination", expanded=True):
+        r_col1, r_col2, r_col3, r_col4 = st.columns(4)
+        with r_col1: x_cases_str = st.text_input("Load Case ทิศ X (คั่นด้วย , เช่น EXP, EXN)", "EX")
+        with r_col2: y_cases_str = st.text_input("Load Case ทิศ Y (คั่นด้วย , เช่น EYP, EYN)", "EY")
+        with r_col3: orthogonal = st.number_input("สัดส่วนทิศตั้งฉาก", min_value=0.0, max_value=1.0, value=0.3, step=0.05)
+        with r_col4: rule_amplifier = st.number_input("ตัวคูณแผ่นดินไหวของ V2, V3, FX, FY", min_value=0.0, value=2.5, step=0.1)
+        sign_flips = st.checkbox("สลับเครื่องหมาย ± ของแรงแผ่นดินไหว", value=True)
+        x_cases = tuple(case.strip() for case in x_cases_str.split(',') if case.strip())
+        y_cases = tuple(case.strip() for case in y_cases_str.split(',') if case.strip())
+        try:
+            combination_set = get_combination_set(x_cases, y_cases, orthogonal, sign_flips, rule_amplifier)
+        except ValueError as e:
+            st.error(f"🚨 กฎการสร้าง Combination ไม่ถูกต้อง: {e}")
+            st.stop()
+        st.caption(f"สร้างได้ {len(combination_set)} Combination จาก Load Case: {', '.join(combination_set.cases)}")
+with st.sidebar:
+    st.caption(
+        f"แคชผลลัพธ์: {len(result_cache)} รายการ | "
+        f"{result_cache.current_bytes / 1024 ** 2:,.0f} / {result_cache.max_bytes / 1024 ** 2:,.0f} MB"
+    )
+    if st.button("ล้างแคช"):
+        result_cache.clear()
+        st.session_state.pop('held_results', None)
+    model_store = get_model_store()
+    if model_store is not None:
+        st.caption(
+            f"คลังโมเดลบนดิสก์: {len(model_store)} รายการ | "
+            f"{model_store.current_bytes / 1024 ** 2:,.0f} / {model_store.max_bytes / 1024 ** 2:,.0f} MB"
+        )
+        if st.button("ล้างคลังโมเดล"):
+            model_store.clear()
+    job_counts = get_job_manager().counts()
+    st.caption(
+        f"งานเบื้องหลัง: กำลังคำนวณ {job_counts['running']} | รอคิว {job_counts['queued']} "
+        f"(คำนวณพร้อมกันได้ {get_job_manager().max_workers} งาน)"
+    )
+    show_diagnostics = st.checkbox(
+        "แสดงข้อมูลการทำงาน (Diagnostics)",
+        help="บันทึกเวลา จำนวนแถว และหน่วยความจำของแต่ละขั้นตอน พร้อมเขียนลง log ของเซิร์ฟเวอร์"
+    )
+    diagnostics_panel = st.container()
+profiler = Profiler(enabled=show_diagnostics, mode=mode)
+if show_diagnostics:
+    enable_stage_logging()
 st.divider()
 
 # --- โหมด Column และ Wall (โค้ดเดิม) ---
@@ -184,7 +365,7 @@ if mode in ['Column', 'Wall']:
             - **`P`**, **`V2`**, **`V3`**, **`T`**, **`M2`**, **`M3`**
             """
         )
-        required_cols = {'Story', 'Column', 'Unique Name', 'Station', 'Output Case', 'P', 'V2', 'V3', 'T', 'M2', 'M3'}
+        required_cols = get_required_cols(mode)
     else: # Wall Mode
         st.info(
             """
@@ -194,27 +375,48 @@ if mode in ['Column', 'Wall']:
             - **`P`**, **`V2`**, **`V3`**, **`T`**, **`M2`**, **`M3`**
             """
         )
-        required_cols = {'Story', 'Pier', 'Location', 'Output Case', 'P', 'V2', 'V3', 'T', 'M2', 'M3'}
+        required_cols = get_required_cols(mode)
 
-    uploaded_file = st.file_uploader(f"เลือกไฟล์สำหรับโหมด {mode}", type=['csv'])
+    uploaded_file = st.file_uploader(f"เลือกไฟล์สำหรับโหมด {mode}", type=INPUT_TYPES)
 
     if uploaded_file is not None:
         try:
-            input_df = pd.read_csv(uploaded_file)
+            file_cols = read_table_columns(uploaded_file)
             
-            if not required_cols.issubset(input_df.columns):
-                missing_cols = required_cols - set(input_df.columns)
+            if not required_cols.issubset(file_cols):
+                missing_cols = required_cols - set(file_cols)
                 st.error(f"🚨 ไฟล์ของคุณขาดคอลัมน์ที่จำเป็นสำหรับโหมด {mode}: **{', '.join(missing_cols)}**")
                 st.stop()
 
-            input_df['Output Case'] = input_df['Output Case'].str.strip()
-            allowed_cases = ['Dead', 'Live', 'SDL', 'EX', 'EY']
-            input_df = input_df[input_df['Output Case'].isin(allowed_cases)]
+            # อ่านเฉพาะคอลัมน์ที่ใช้ และกรองเหลือ Dead/SDL/Live/EX/EY ระหว่างอ่านแต่ละส่วน
+            # ผลลัพธ์ทุกขั้นตอนถูกแคชด้วยแฮชของไฟล์ + โหมด + ตัวเลือก จึงไม่ต้องคำนวณใหม่เมื่อหน้าเว็บรันซ้ำ
+            # เมทริกซ์ที่ pivot แล้วเก็บในคลังบนดิสก์ด้วย ไฟล์เดิมจึงเปิดได้ทันทีแม้เซิร์ฟเวอร์รีสตาร์ท
+            # การคำนวณทุกขั้นตอนทำเป็นงานเบื้องหลัง ผู้ใช้หลายคนที่อัปโหลดไฟล์เดียวกันจะรอผลจากงานเดียวกัน
+            file_hash = get_upload_hash(uploaded_file)
+            file_key = (file_hash, mode, downcast, tuple(combination_set.cases))
+            model = run_in_background(
+                ('model',) + file_key,
+                lambda job_profiler: load_case_matrix(
+                    copy_upload(uploaded_file), mode, downcast=downcast, cases=combination_set.cases,
+                    store=model_store, store_key=('matrix',) + file_key, profiler=job_profiler,
+                ),
+                "การอ่านไฟล์", profiler,
+            )
+            if model is None:
+                st.stop()
+            case_matrix, model_info = model
+            # ไฟล์ก่อนหน้าที่อ่านด้วยตัวเลือกเดียวกัน ใช้เทียบและคำนวณเฉพาะชิ้นส่วนที่เปลี่ยนได้
+            previous, old_matrix = track_revision(
+                mode, (file_hash,), uploaded_file.name, lambda upload: upload + file_key[1:]
+            ), None
+            if previous is not None:
+                old_matrix = get_previous_matrix(previous['key'])
             st.success("✔️ อัปโหลดไฟล์สำเร็จแล้ว!")
+            st.caption(format_model_source(model_info))
             
             st.subheader("ตรวจสอบไฟล์เบื้องต้น")
-            required_oc_cases = {'Dead', 'Live', 'SDL', 'EX', 'EY'}
-            uploaded_cases = set(input_df['Output Case'].unique())
+            required_oc_cases = set(combination_set.cases)
+            uploaded_cases = set(model_info['cases_present'])
             missing_oc_cases = required_oc_cases - uploaded_cases
             
             if not missing_oc_cases:
@@ -228,76 +430,160 @@ if mode in ['Column', 'Wall']:
             if can_proceed:
                 if 'main_result_df' not in st.session_state:
                     st.session_state.main_result_df, st.session_state.ug_result_df = None, None
+                    st.session_state.ug_result_key, st.session_state.ug_request = None, None
 
                 st.subheader("ข้อมูลดิบจากไฟล์ที่อัปโหลด (หลังกรองแล้ว)")
-                st.dataframe(input_df.head())
+                st.dataframe(model_info['preview'])
                 st.header("1. ผลการคำนวณ Load Combinations")
                 with st.expander("แสดง/ซ่อนสูตรที่ใช้คำนวณ"):
-                    st.markdown("""
-                    - **U01**: `1.4*Dead + 1.4*SDL + 1.7*Live`
-                    - **U02**: `1.05*Dead + 1.05*SDL + 1.275*Live + EX`
-                    - ... (และสูตรอื่นๆ)
-                    - **หมายเหตุ:** สำหรับค่า `V2` และ `V3` เทอม `EX` และ `EY` จะถูกคูณด้วย **2.5**
-                    """)
+                    if combination_set is STANDARD_COMBINATION_SET:
+                        st.markdown("""
+                        - **U01**: `1.4*Dead + 1.4*SDL + 1.7*Live`
+                        - **U02**: `1.05*Dead + 1.05*SDL + 1.275*Live + EX`
+                        - ... (และสูตรอื่นๆ)
+                        - **หมายเหตุ:** สำหรับค่า `V2` และ `V3` เทอม `EX` และ `EY` จะถูกคูณด้วย **2.5**
+                        """)
+                    else:
+                        combo_names = combination_set.coefficients(MEMBER_VALUE_COLS)[0]
+                        st.markdown("\n".join(f"- `{name}`" for name in combo_names))
+                        st.markdown(f"- **หมายเหตุ:** สำหรับค่า `V2` และ `V3` เทอมแผ่นดินไหวจะถูกคูณด้วย **{rule_amplifier:g}**")
                 
-                with st.spinner('กำลังคำนวณ Load Combinations... ⏳'):
-                    st.session_state.main_result_df = calculate_combinations(input_df, mode=mode)
-                st.success("✔️ คำนวณเสร็จสิ้น!")
+                main_key = ('result',) + file_key + (combination_set.key, envelope)
+                previous_result = None
+                if old_matrix is not None:
+                    previous_result = get_result(('result',) + previous['key'] + (combination_set.key, envelope))
+
+                def compute_main(job_profiler):
+                    if previous_result is None:
+                        return calculate_combinations(
+                            None, mode=mode, envelope=envelope, case_matrix=case_matrix, profiler=job_profiler,
+                            combination_set=combination_set,
+                        )
+                    diff_df = get_revision_diff(previous, file_key, old_matrix, case_matrix, mode, None, job_profiler)
+                    return calculate_incremental_combinations(
+                        previous_result, diff_df, case_matrix, mode=mode, envelope=envelope, profiler=job_profiler,
+                        combination_set=combination_set,
+                    )
 
-                # --- (ส่วนของ Underground Floor เหมือนเดิม) ---
+                st.session_state.main_result_df = run_in_background(
+                    main_key, compute_main, "การคำนวณ Load Combinations", profiler
+                )
+                if st.session_state.main_result_df is None:
+                    st.stop()
+                result_key = file_key + (combination_set.key,)
+                st.success("✔️ คำนวณเสร็จสิ้น!")
+                if old_matrix is not None:
+                    with st.expander("🔄 การเปลี่ยนแปลงจากไฟล์ก่อนหน้า (Revision)", expanded=True):
+                        show_revision_changes(
+                            previous, file_key, old_matrix, case_matrix, mode, profiler,
+                            combination_set=combination_set, incremental=previous_result is not None,
+                        )
+
+                # --- ส่วนของ Underground Floor ---
                 st.header("2. คำนวณเพิ่มเติมสำหรับชั้นใต้ดิน (Underground Floor)")
-                # ... (โค้ดส่วนนี้เหมือนเดิมทั้งหมด) ...
-                stories = sorted(input_df['Story'].unique())
+                stories = sorted(case_matrix[0]['Story'].unique())
                 base_story = st.selectbox("เลือกชั้นที่จะใช้เป็นฐานในการคำนวณ:", options=stories)
-                st.write("กรอกตัวคูณ (Factor) ที่ต้องการสำหรับชั้นใต้ดิน:")
-                col1, col2, col3 = st.columns(3)
-                with col1: factor_dead_str = st.text_input("Factor for Dead Load", "1.0")
-                with col2: factor_sdl_str = st.text_input("Factor for SDL", "1.0")
-                with col3: factor_live_str = st.text_input("Factor for Live Load", "1.0")
+                st.write("กรอกชื่อชั้นและตัวคูณ (Factor) ที่ต้องการสำหรับชั้นใต้ดิน (เพิ่มแถวเพื่อคำนวณหลายชั้นพร้อมกัน):")
+                ug_levels_df = st.data_editor(
+                    pd.DataFrame([{'Story': 'Underground', 'Dead': 1.0, 'SDL': 1.0, 'Live': 1.0}]),
+                    num_rows="dynamic",
+                    hide_index=True,
+                    column_config={
+                        'Story': st.column_config.TextColumn("ชื่อชั้น", required=True),
+                        'Dead': st.column_config.NumberColumn("Factor for Dead Load", min_value=0.0, step=0.01, format="%.2f", required=True),
+                        'SDL': st.column_config.NumberColumn("Factor for SDL", min_value=0.0, step=0.01, format="%.2f", required=True),
+                        'Live': st.column_config.NumberColumn("Factor for Live Load", min_value=0.0, step=0.01, format="%.2f", required=True),
+                    },
+                    key="ug_levels",
+                )
                 merge_results = st.checkbox("รวมผลลัพธ์ของชั้นใต้ดินกับตารางผลลัพธ์หลัก")
                 if st.button("คำนวณชั้นใต้ดิน", type="primary"):
-                    pattern = re.compile(r"^\d+(\.\d{1,2})?$")
-                    if all(pattern.match(s) for s in [factor_dead_str, factor_sdl_str, factor_live_str]):
-                        factor_dead, factor_sdl, factor_live = map(float, [factor_dead_str, factor_sdl_str, factor_live_str])
-                        with st.spinner('กำลังสร้างข้อมูลชั้นใต้ดิน... ⏳'):
-                            base_floor_df = input_df[input_df['Story'] == base_story].copy()
-                            value_cols_ug = ['P', 'V2', 'V3', 'T', 'M2', 'M3']
-                            factors_map = {'Dead': factor_dead, 'SDL': factor_sdl, 'Live': factor_live}
-                            dfs_to_combine = []
-                            unmodified_mask = ~base_floor_df['Output Case'].isin(factors_map.keys())
-                            dfs_to_combine.append(base_floor_df[unmodified_mask])
-                            for case, factor in factors_map.items():
-                                mask = base_floor_df['Output Case'] == case
-                                if mask.any():
-                                    modified_part = base_floor_df[mask].copy()
-                                    modified_part[value_cols_ug] *= factor
-                                    dfs_to_combine.append(modified_part)
-                            ug_df_raw = pd.concat(dfs_to_combine).reset_index(drop=True)
-                            st.session_state.ug_result_df = calculate_combinations(ug_df_raw, custom_story_name="Underground", mode=mode)
-                            st.success("✔️ คำนวณชั้นใต้ดินเสร็จสิ้น!")
+                    ug_levels_df = ug_levels_df.dropna(how='all')
+                    level_names = ug_levels_df['Story'].fillna('').astype(str).str.strip()
+                    level_factors = ug_levels_df[['Dead', 'SDL', 'Live']]
+                    if (len(ug_levels_df) > 0 and (level_names != '').all() and level_names.is_unique
+                            and level_factors.notna().all().all() and (level_factors >= 0).all().all()):
+                        levels = {
+                            name: {case: float(row[case]) for case in ['Dead', 'SDL', 'Live']}
+                            for name, (_, row) in zip(level_names, level_factors.iterrows())
+                        }
+                        levels_key = tuple((name, tuple(f.items())) for name, f in levels.items())
+                        ug_key = ('underground',) + result_key + (base_story, levels_key, envelope)
+                        st.session_state.ug_request = (ug_key, base_story, levels)
                     else:
-                        st.error("🚨 รูปแบบตัวเลขไม่ถูกต้อง!")
-                        st.session_state.ug_result_df = None
+                        st.error("🚨 ข้อมูลชั้นใต้ดินไม่ถูกต้อง! ชื่อชั้นต้องไม่ว่างและไม่ซ้ำกัน และ Factor ต้องเป็นตัวเลขตั้งแต่ 0 ขึ้นไป")
+                        st.session_state.ug_request = None
+
+                # ผลชั้นใต้ดินที่คำนวณจากไฟล์หรือตัวเลือกอื่นใช้รวมกับผลลัพธ์ชุดนี้ไม่ได้
+                st.session_state.ug_result_df, st.session_state.ug_result_key = None, None
+                ug_request = st.session_state.ug_request
+                if (ug_request is not None and ug_request[0][1:1 + len(result_key)] == result_key
+                        and ug_request[0][-1] == envelope):
+                    ug_key, ug_base_story, ug_levels = ug_request
+                    ug_df = run_in_background(
+                        ug_key,
+                        lambda job_profiler: calculate_underground_combinations(
+                            case_matrix, ug_base_story, ug_levels, mode=mode, envelope=envelope,
+                            profiler=job_profiler, combination_set=combination_set,
+                        ),
+                        "การคำนวณชั้นใต้ดิน", profiler,
+                    )
+                    if ug_df is not None:
+                        st.session_state.ug_result_df, st.session_state.ug_result_key = ug_df, ug_key
+                        st.success("✔️ คำนวณชั้นใต้ดินเสร็จสิ้น!")
                 
                 st.divider()
                 st.header("3. ผลลัพธ์ทั้งหมด")
                 # ... (ส่วนแสดงผลและดาวน์โหลดเหมือนเดิม) ...
-                final_df = st.session_state.main_result_df.copy() if st.session_state.main_result_df is not None else None
+                # ผลลัพธ์ในแคชใช้ร่วมกันหลาย Session จึงห้ามแก้ไขตารางโดยตรง
+                final_df = st.session_state.main_result_df
+                download_key = ('download', download_format, main_key)
                 if merge_results and st.session_state.ug_result_df is not None:
-                    final_df = pd.concat([st.session_state.main_result_df, st.session_state.ug_result_df], ignore_index=True)
+                    download_key += (st.session_state.ug_result_key,)
+                    # สร้างตารางรวมครั้งเดียวต่อผลลัพธ์คู่นี้ ไม่ต่อตารางใหม่ทุกครั้งที่เปลี่ยนหน้าหรือตัวกรอง
+                    final_df = get_or_compute_result(
+                        ('combined', main_key, st.session_state.ug_result_key),
+                        lambda: pd.concat([st.session_state.main_result_df, st.session_state.ug_result_df], ignore_index=True),
+                        profiler,
+                    )
                     st.info("ตารางแสดงผลลัพธ์หลัก **รวมกับ** ผลลัพธ์ของชั้นใต้ดิน")
                     file_name = "load_combinations_combined_result.csv"
                 else:
                     st.info("ตารางแสดงผลลัพธ์หลัก (หากต้องการรวมชั้นใต้ดิน, กรุณาติ๊ก ✔️ และกดคำนวณ)")
                     if st.session_state.ug_result_df is not None:
                         st.write("ผลลัพธ์ชั้นใต้ดิน (แยกส่วน)")
-                        st.dataframe(st.session_state.ug_result_df)
+                        show_result_table(st.session_state.ug_result_df, st.session_state.ug_result_key, 'ug_view', profiler)
                     file_name = "load_combinations_result.csv"
-                st.dataframe(final_df)
-                @st.cache_data
-                def convert_df_to_csv(df): return df.to_csv(index=False).encode('utf-8')
+                show_result_table(final_df, download_key[2:], 'main_view', profiler)
                 if final_df is not None:
-                    st.download_button("📥 ดาวน์โหลดผลลัพธ์ทั้งหมดเป็น CSV", convert_df_to_csv(final_df), file_name, 'text/csv')
+                    def serialize_final():
+                        with profiler.stage('serialize', pipeline=mode, rows_in=len(final_df)):
+                            return serialize_result(final_df, download_format, entry_name=file_name)
+                    file_data = get_or_compute_result(download_key, serialize_final, profiler)
+                    st.download_button(
+                        f"📥 ดาวน์โหลดผลลัพธ์ทั้งหมดเป็น {download_labels[download_format]}",
+                        file_data, get_output_file_name(file_name, download_format), download_mime
+                    )
+
+                # --- Combination ที่ควบคุมและชิ้นส่วนวิกฤต ---
+                st.divider()
+                st.header("4. Combination ที่ควบคุมและชิ้นส่วนวิกฤต")
+                st.write("แรงตามแนวแกน |P|, แรงเฉือนลัพธ์ √(V2²+V3²) และโมเมนต์ลัพธ์ √(M2²+M3²) สูงสุดของแต่ละชิ้นส่วน พร้อมแรงอื่นที่เกิดพร้อมกัน")
+                top_k = st.number_input("จำนวนชิ้นส่วนวิกฤตต่อชั้น", min_value=1, value=10, step=1, key="top_k")
+                governing_key = ('governing',) + result_key + (int(top_k),)
+                governing = run_in_background(
+                    governing_key,
+                    lambda job_profiler: calculate_governing_combinations(
+                        case_matrix, mode=mode, top_k=int(top_k), profiler=job_profiler,
+                        combination_set=combination_set,
+                    ),
+                    "การหา Combination ที่ควบคุม", profiler,
+                )
+                if governing is not None:
+                    governing_df, critical_df = governing
+                    st.dataframe(critical_df, hide_index=True)
+                    with st.expander("Combination ที่ควบคุมของทุกชิ้นส่วน"):
+                        show_result_table(governing_df, governing_key, 'governing_view', profiler)
 
         except Exception as e:
             st.error(f"เกิดข้อผิดพลาดในการประมวลผลไฟล์: {e}")
@@ -315,20 +601,20 @@ else: # mode == 'Reaction'
     
     col1, col2 = st.columns(2)
     with col1:
-        uploaded_load_file = st.file_uploader("1. อัปโหลดไฟล์ Load", type=['csv'], key="reaction_load")
+        uploaded_load_file = st.file_uploader("1. อัปโหลดไฟล์ Load", type=INPUT_TYPES, key="reaction_load")
     with col2:
         uploaded_coord_file = st.file_uploader("2. อัปโหลดไฟล์พิกัด", type=['csv'], key="reaction_xy")
 
     if uploaded_load_file is not None and uploaded_coord_file is not None:
         try:
-            df_load = pd.read_csv(uploaded_load_file)
+            load_cols = read_table_columns(uploaded_load_file)
             df_coords = pd.read_csv(uploaded_coord_file)
 
-            required_load_cols = {'Story', 'Unique Name', 'Output Case', 'FX', 'FY', 'FZ', 'MX', 'MY', 'MZ'}
+            required_load_cols = get_required_cols('Reaction')
             required_coord_cols = {'UniqueName', 'X', 'Y', 'Z'}
 
-            if not required_load_cols.issubset(df_load.columns):
-                missing = required_load_cols - set(df_load.columns)
+            if not required_load_cols.issubset(load_cols):
+                missing = required_load_cols - set(load_cols)
                 st.error(f"🚨 ไฟล์ Load ขาดคอลัมน์: **{', '.join(missing)}**")
                 st.stop()
             
@@ -337,13 +623,24 @@ else: # mode == 'Reaction'
                 st.error(f"🚨 ไฟล์พิกัดขาดคอลัมน์: **{', '.join(missing)}**")
                 st.stop()
 
-            df_load['Output Case'] = df_load['Output Case'].str.strip()
-            allowed_cases = ['Dead', 'Live', 'SDL', 'EX', 'EY']
-            df_load_filtered = df_load[df_load['Output Case'].isin(allowed_cases)].copy()
+            load_key = (get_upload_hash(uploaded_load_file), 'Reaction', downcast, tuple(combination_set.cases))
+            # เมทริกซ์ที่ pivot ไว้ไม่ขึ้นกับ Factor (คูณ Factor บนสำเนาตอนคำนวณ) จึงใช้ซ้ำได้ทุกชุด Factor
+            model = run_in_background(
+                ('model',) + load_key,
+                lambda job_profiler: load_case_matrix(
+                    copy_upload(uploaded_load_file), 'Reaction', downcast=downcast, cases=combination_set.cases,
+                    store=model_store, store_key=('matrix',) + load_key, profiler=job_profiler,
+                ),
+                "การอ่านไฟล์ Load", profiler,
+            )
+            if model is None:
+                st.stop()
+            case_matrix, model_info = model
             st.success("✔️ อัปโหลดไฟล์ทั้ง 2 สำเร็จ!")
+            st.caption(format_model_source(model_info))
 
-            required_oc_cases = {'Dead', 'Live', 'SDL', 'EX', 'EY'}
-            uploaded_cases = set(df_load_filtered['Output Case'].unique())
+            required_oc_cases = set(combination_set.cases)
+            uploaded_cases = set(model_info['cases_present'])
             missing_oc_cases = required_oc_cases - uploaded_cases
             if missing_oc_cases:
                 st.error(f"🚨 ไฟล์ Load ขาด Output Case ที่จำเป็น: **{', '.join(sorted(list(missing_oc_cases)))}**")
@@ -353,7 +650,7 @@ else: # mode == 'Reaction'
             
             st.subheader("ข้อมูลดิบ (ตัวอย่าง 5 แถวแรก)")
             st.write("ไฟล์ Load (หลังกรองแล้ว):")
-            st.dataframe(df_load_filtered.head())
+            st.dataframe(model_info['preview'])
             st.write("ไฟล์พิกัด:")
             st.dataframe(df_coords.head())
 
@@ -365,37 +662,183 @@ else: # mode == 'Reaction'
             with f_col1: factor_dead_str = st.text_input("Factor for Dead Load", "1.0", key="f_dead_r")
             with f_col2: factor_sdl_str = st.text_input("Factor for SDL", "1.0", key="f_sdl_r")
             with f_col3: factor_live_str = st.text_input("Factor for Live Load", "1.0", key="f_live_r")
+            top_k = st.number_input("จำนวนจุดรองรับวิกฤตต่อชั้น", min_value=1, value=10, step=1, key="top_k_r")
             
             st.divider()
             
-            if st.button("คำนวณ Reaction Combination", type="primary"):
-                pattern = re.compile(r"^\d+(\.\d+)?$")
-                if all(pattern.match(s) for s in [factor_dead_str, factor_sdl_str, factor_live_str]):
-                    factors = {
-                        'Dead': float(factor_dead_str),
-                        'SDL': float(factor_sdl_str),
-                        'Live': float(factor_live_str)
-                    }
-                    
-                    with st.spinner('กำลังคำนวณ... ⏳'):
-                        result_df = calculate_reaction_combinations(df_load_filtered, df_coords, factors)
-                        st.session_state.reaction_result_df = result_df
-
-                    st.success("✔️ คำนวณเสร็จสิ้น!")
-                    st.header("2. ผลลัพธ์การคำนวณ")
-                    st.dataframe(st.session_state.reaction_result_df)
-                    
-                    @st.cache_data
-                    def convert_df_to_csv_reaction(df): return df.to_csv(index=False).encode('utf-8')
-                    
-                    st.download_button(
-                        "📥 ดาวน์โหลดผลลัพธ์เป็น CSV",
-                        convert_df_to_csv_reaction(st.session_state.reaction_result_df),
-                        "reaction_combinations_result.csv",
-                        'text/csv'
+            pattern = re.compile(r"^\d+(\.\d+)?$")
+            factors_valid = all(pattern.match(s) for s in [factor_dead_str, factor_sdl_str, factor_live_str])
+            factors = None
+            if factors_valid:
+                factors = {
+                    'Dead': float(factor_dead_str),
+                    'SDL': float(factor_sdl_str),
+                    'Live': float(factor_live_str)
+                }
+            coords_hash = get_upload_hash(uploaded_coord_file)
+            # Revision ของโหมด Reaction รวมไฟล์พิกัดด้วย เพราะพิกัดอยู่ในตารางผลลัพธ์
+            revision_key = load_key + (coords_hash,)
+            previous = track_revision(
+                'Reaction', (load_key[0], coords_hash), uploaded_load_file.name,
+                lambda upload: upload[:1] + load_key[1:] + upload[1:], df_coords,
+            )
+            old_matrix = None
+            if previous is not None:
+                old_matrix = get_previous_matrix(previous['key'][:len(load_key)])
+
+            # ผลลัพธ์ที่กดคำนวณแล้วยังแสดงอยู่เมื่อหน้าเว็บรันซ้ำ (เช่น เปลี่ยนหน้าตาราง) ตราบใดที่ไฟล์และตัวเลือกไม่เปลี่ยน
+            reaction_key, previous_result = None, None
+            if factors_valid:
+                result_options = (tuple(factors.items()), combination_set.key, envelope)
+                reaction_key = ('reaction',) + revision_key + result_options
+                if old_matrix is not None:
+                    previous_result = get_result(('reaction',) + previous['key'] + result_options)
+
+            def compute_reaction(job_profiler):
+                if previous_result is None:
+                    return calculate_reaction_combinations(
+                        None, df_coords, factors, envelope=envelope, case_matrix=case_matrix,
+                        profiler=job_profiler, combination_set=combination_set,
                     )
+                diff_df = get_revision_diff(
+                    previous, revision_key, old_matrix, case_matrix, 'Reaction', df_coords, job_profiler
+                )
+                return calculate_incremental_combinations(
+                    previous_result, diff_df, case_matrix, mode='Reaction', envelope=envelope,
+                    pre_combo_factors=factors, df_coords=df_coords, profiler=job_profiler,
+                    combination_set=combination_set,
+                )
+
+            if st.button("คำนวณ Reaction Combination", type="primary"):
+                if factors_valid:
+                    st.session_state.reaction_result_key = reaction_key
                 else:
                     st.error("🚨 รูปแบบตัวเลข Factor ไม่ถูกต้อง! กรุณาใส่เป็นตัวเลข เช่น 1.0, 0.95")
 
+            result_df = None
+            if reaction_key is not None and st.session_state.get('reaction_result_key') == reaction_key:
+                result_df = run_in_background(reaction_key, compute_reaction, "การคำนวณ Reaction Combination", profiler)
+            if result_df is not None:
+                st.success("✔️ คำนวณเสร็จสิ้น!")
+                st.header("2. ผลลัพธ์การคำนวณ")
+                show_result_table(result_df, reaction_key, 'reaction_view', profiler)
+
+                def serialize_reaction():
+                    with profiler.stage('serialize', pipeline='Reaction', rows_in=len(result_df)):
+                        return serialize_result(result_df, download_format, entry_name="reaction_combinations_result.csv")
+                file_data = get_or_compute_result(('download', download_format, reaction_key), serialize_reaction, profiler)
+                st.download_button(
+                    f"📥 ดาวน์โหลดผลลัพธ์เป็น {download_labels[download_format]}",
+                    file_data,
+                    get_output_file_name("reaction_combinations_result.csv", download_format),
+                    download_mime
+                )
+                if old_matrix is not None:
+                    with st.expander("🔄 การเปลี่ยนแปลงจากไฟล์ก่อนหน้า (Revision)", expanded=True):
+                        show_revision_changes(
+                            previous, revision_key, old_matrix, case_matrix, 'Reaction', profiler,
+                            pre_combo_factors=factors, df_coords=df_coords, combination_set=combination_set,
+                            incremental=previous_result is not None,
+                        )
+
+                st.subheader("Combination ที่ควบคุมและจุดรองรับวิกฤต")
+                st.write("แรงกด (FZ บวก), แรงถอน (FZ ลบ), แรงเฉือนลัพธ์ √(FX²+FY²) และโมเมนต์ลัพธ์ √(MX²+MY²) สูงสุดของแต่ละจุด")
+                governing_key = ('governing',) + reaction_key[1:-1] + (int(top_k),)
+                governing = run_in_background(
+                    governing_key,
+                    lambda job_profiler: calculate_governing_combinations(
+                        case_matrix, mode='Reaction', pre_combo_factors=factors, top_k=int(top_k),
+                        profiler=job_profiler, combination_set=combination_set,
+                    ),
+                    "การหา Combination ที่ควบคุม", profiler,
+                )
+                if governing is not None:
+                    governing_df, critical_df = governing
+                    st.dataframe(critical_df, hide_index=True)
+                    with st.expander("Combination ที่ควบคุมของทุกจุด"):
+                        show_result_table(governing_df, governing_key, 'reaction_governing_view', profiler)
+
+            # --- การรวมแรงตามกลุ่มเสาเข็ม / ฐานรากร่วม ---
+            st.divider()
+            st.subheader("3. รวมแรงตามกลุ่มฐานราก (Pile cap / Combined footing)")
+            st.write("จัดกลุ่มจุดรองรับตามระยะห่าง หรือตามรูปหลายเหลี่ยมของฐานราก แล้วคำนวณแรงลัพธ์และโมเมนต์รอบจุดศูนย์กลางกลุ่มสำหรับทุก Combination")
+            group_method = st.radio(
+                "วิธีจัดกลุ่ม", ('ระยะห่างระหว่างจุด', 'ไฟล์รูปหลายเหลี่ยม'), horizontal=True, key="group_method"
+            )
+            group_radius, df_polygons, grouping_key = None, None, None
+            if group_method == 'ระยะห่างระหว่างจุด':
+                group_radius = st.number_input(
+                    "ระยะห่างสูงสุดระหว่างจุดในกลุ่มเดียวกัน", min_value=0.001, value=1.5, step=0.1, format="%.3f",
+                    help="จุดที่ห่างกันไม่เกินระยะนี้ (ต่อเนื่องกันเป็นทอดๆ) จะอยู่ในกลุ่มเดียวกัน",
+                )
+                grouping_key = ('radius', group_radius)
+            else:
+                uploaded_polygon_file = st.file_uploader(
+                    "อัปโหลดไฟล์รูปหลายเหลี่ยม (คอลัมน์ `Group`, `X`, `Y` เรียงตามลำดับจุดยอด)", type=['csv'],
+                    key="footing_polygons",
+                )
+                if uploaded_polygon_file is not None:
+                    df_polygons = pd.read_csv(uploaded_polygon_file)
+                    missing = {'Group', 'X', 'Y'} - set(df_polygons.columns)
+                    if missing:
+                        st.error(f"🚨 ไฟล์รูปหลายเหลี่ยมขาดคอลัมน์: **{', '.join(sorted(missing))}**")
+                        st.stop()
+                    grouping_key = ('polygons', get_upload_hash(uploaded_polygon_file))
+
+            footing_key = None
+            if factors_valid and grouping_key is not None:
+                footing_key = ('footing',) + load_key + (coords_hash, tuple(factors.items()), combination_set.key, grouping_key)
+
+            if st.button("คำนวณแรงลัพธ์ของกลุ่ม"):
+                if not factors_valid:
+                    st.error("🚨 รูปแบบตัวเลข Factor ไม่ถูกต้อง! กรุณาใส่เป็นตัวเลข เช่น 1.0, 0.95")
+                elif grouping_key is None:
+                    st.error("🚨 กรุณาอัปโหลดไฟล์รูปหลายเหลี่ยม")
+                else:
+                    st.session_state.footing_result_key = footing_key
+
+            footing = None
+            if footing_key is not None and st.session_state.get('footing_result_key') == footing_key:
+                footing = run_in_background(
+                    footing_key,
+                    lambda job_profiler: calculate_group_resultants(
+                        case_matrix, df_coords, factors, radius=group_radius, df_polygons=df_polygons,
+                        profiler=job_profiler, combination_set=combination_set,
+                    ),
+                    "การคำนวณแรงลัพธ์ของกลุ่ม", profiler,
+                )
+            if footing is not None:
+                group_df, membership_df = footing
+                n_groups = membership_df['Group'].nunique()
+                n_missing = membership_df['Group'].isna().sum()
+                st.success(f"✔️ จัดได้ {n_groups:,} กลุ่มจาก {len(membership_df):,} จุดรองรับ")
+                if n_missing:
+                    st.warning(f"⚠️ มี {n_missing:,} จุดที่ไม่พบพิกัด จึงไม่ได้นำไปรวมในกลุ่มใด")
+                show_result_table(group_df, footing_key, 'footing_view', profiler)
+                with st.expander("จุดรองรับในแต่ละกลุ่ม"):
+                    show_result_table(membership_df, footing_key + ('membership',), 'membership_view', profiler)
+
+                def serialize_footing():
+                    with profiler.stage('serialize', pipeline='Footing', rows_in=len(group_df)):
+                        return serialize_result(group_df, download_format, entry_name="footing_group_resultants.csv")
+                file_data = get_or_compute_result(('download', download_format, footing_key), serialize_footing, profiler)
+                st.download_button(
+                    f"📥 ดาวน์โหลดแรงลัพธ์ของกลุ่มเป็น {download_labels[download_format]}",
+                    file_data,
+                    get_output_file_name("footing_group_resultants.csv", download_format),
+                    download_mime
+                )
+
         except Exception as e:
             st.error(f"เกิดข้อผิดพลาดในการประมวลผลไฟล์: {e}")
+
+# --- แผงข้อมูลการทำงาน (Diagnostics) ---
+if show_diagnostics:
+    with diagnostics_panel:
+        with st.expander("ข้อมูลการทำงานแต่ละขั้นตอน", expanded=True):
+            stage_df = profiler.to_frame()
+            if stage_df.empty:
+                st.caption("ยังไม่มีขั้นตอนที่ถูกบันทึกในการรันครั้งนี้")
+            else:
+                st.caption(f"รวม {stage_df['seconds'].sum():,.3f} วินาที")
+                st.dataframe(stage_df.drop(columns=['mode']), hide_index=True)
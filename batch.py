@@ -0,0 +1,173 @@
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from load_combination import (
+    OUTPUT_FORMATS, STANDARD_COMBINATION_SET, calculate_combinations, calculate_reaction_combinations,
+    get_peak_memory_mb, get_required_cols, load_combination_rules, read_table_columns, read_load_table, write_result,
+)
+
+
+SUMMARY_COLS = ['file', 'status', 'rows_read', 'rows_kept', 'result_rows', 'seconds', 'peak_memory_mb', 'output', 'error']
+
+
+# --- โหมดประมวลผลแบบไม่ใช้หน้าเว็บ (รันหลายไฟล์พร้อมกันบนทุกคอร์) ---
+def load_input(path, mode, downcast=False, combination_set=STANDARD_COMBINATION_SET):
+    required_cols = get_required_cols(mode)
+    missing_cols = required_cols - set(read_table_columns(path))
+    if missing_cols:
+        raise ValueError(f"missing columns: {', '.join(sorted(missing_cols))}")
+    df, stats = read_load_table(path, required_cols, downcast=downcast, cases=combination_set.cases)
+    missing_cases = set(combination_set.cases) - set(df['Output Case'].unique())
+    if missing_cases:
+        raise ValueError(f"missing Output Case: {', '.join(sorted(missing_cases))}")
+    return df, stats
+
+
+def combine_part(df, mode, coords=None, pre_combo_factors=None, envelope=False,
+                 combination_set=STANDARD_COMBINATION_SET):
+    if mode == 'Reaction':
+        return calculate_reaction_combinations(
+            df, coords.copy(), pre_combo_factors or {}, envelope=envelope, combination_set=combination_set
+        )
+    return calculate_combinations(df, mode=mode, envelope=envelope, combination_set=combination_set)
+
+
+def save_result(result_df, output_path, output_format):
+    # ชื่อไฟล์ CSV ภายใน zip ใช้ชื่อเดียวกับไฟล์ผลลัพธ์
+    entry_name = os.path.splitext(os.path.basename(output_path))[0] + '.csv'
+    with open(output_path, 'wb') as f:
+        write_result(result_df, f, output_format, entry_name=entry_name)
+
+
+def process_file(path, output_path, mode, coords=None, pre_combo_factors=None, envelope=False, downcast=False,
+                 output_format='csv', combination_set=STANDARD_COMBINATION_SET):
+    start = time.perf_counter()
+    summary = {'file': os.path.basename(path), 'status': 'ok', 'error': ''}
+    try:
+        df, stats = load_input(path, mode, downcast=downcast, combination_set=combination_set)
+        result_df = combine_part(df, mode, coords, pre_combo_factors, envelope, combination_set)
+        save_result(result_df, output_path, output_format)
+        summary.update(rows_read=stats['rows_read'], rows_kept=stats['rows_kept'], result_rows=len(result_df),
+                       output=os.path.basename(output_path))
+    except Exception as e:
+        summary.update(status='error', error=str(e))
+    summary['seconds'] = round(time.perf_counter() - start, 3)
+    summary['peak_memory_mb'] = get_peak_memory_mb()
+    return summary
+
+
+def process_file_by_story(executor, path, output_path, mode, coords=None, pre_combo_factors=None,
+                          envelope=False, downcast=False, output_format='csv', combination_set=STANDARD_COMBINATION_SET):
+    # Story เป็นคีย์แรกของทุกโหมด จึงแบ่งไฟล์เป็นชั้นๆ แล้วคำนวณแยกกันได้โดยผลลัพธ์ไม่เปลี่ยน
+    start = time.perf_counter()
+    summary = {'file': os.path.basename(path), 'status': 'ok', 'error': ''}
+    try:
+        df, stats = load_input(path, mode, downcast=downcast, combination_set=combination_set)
+        futures = [
+            executor.submit(combine_part, story_df, mode, coords, pre_combo_factors, envelope, combination_set)
+            for _, story_df in df.groupby('Story', sort=True, observed=True)
+        ]
+        story_results = [future.result() for future in futures]
+        result_df = pd.concat(story_results, ignore_index=True)
+        if not envelope:
+            # เรียงให้เหมือนการคำนวณทั้งไฟล์: Combination ก่อน แล้วตามด้วยชั้น
+            combo_order = pd.Categorical(result_df['Output Case'], categories=pd.unique(result_df['Output Case']))
+            result_df = result_df.iloc[pd.Series(combo_order.codes).argsort(kind='stable')].reset_index(drop=True)
+        save_result(result_df, output_path, output_format)
+        summary.update(rows_read=stats['rows_read'], rows_kept=stats['rows_kept'], result_rows=len(result_df),
+                       output=os.path.basename(output_path))
+    except Exception as e:
+        summary.update(status='error', error=str(e))
+    summary['seconds'] = round(time.perf_counter() - start, 3)
+    summary['peak_memory_mb'] = get_peak_memory_mb()
+    return summary
+
+
+def find_input_files(input_dir, pattern='*.csv', exclude=()):
+    exclude = {os.path.abspath(path) for path in exclude if path}
+    paths = sorted(glob.glob(os.path.join(input_dir, pattern)))
+    return [path for path in paths if os.path.abspath(path) not in exclude]
+
+
+def run_batch(input_dir, mode, output_dir=None, coords_path=None, pre_combo_factors=None, envelope=False,
+              downcast=False, workers=None, partition='file', pattern='*.csv', output_format='csv',
+              combination_set=STANDARD_COMBINATION_SET):
+    if mode not in ('Column', 'Wall', 'Reaction'):
+        raise ValueError(f"Unknown mode: {mode}")
+    if mode == 'Reaction' and coords_path is None:
+        raise ValueError("Reaction mode requires a coordinate file")
+    if partition not in ('file', 'story'):
+        raise ValueError(f"Unknown partition: {partition}")
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format}")
+
+    output_dir = output_dir or os.path.join(input_dir, 'results')
+    os.makedirs(output_dir, exist_ok=True)
+    coords = pd.read_csv(coords_path) if coords_path else None
+    suffix = '_envelope' if envelope else '_combinations'
+    paths = find_input_files(input_dir, pattern, exclude=[coords_path])
+
+    def output_path_for(path):
+        base_name = os.path.splitext(os.path.basename(path))[0] + suffix
+        return os.path.join(output_dir, base_name + OUTPUT_FORMATS[output_format][0])
+
+    options = dict(mode=mode, coords=coords, pre_combo_factors=pre_combo_factors, envelope=envelope, downcast=downcast,
+                   output_format=output_format, combination_set=combination_set)
+    summaries = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        if partition == 'file':
+            futures = [executor.submit(process_file, path, output_path_for(path), **options) for path in paths]
+            summaries = [future.result() for future in as_completed(futures)]
+        else:
+            # อ่านทีละไฟล์ในโปรเซสหลัก และกระจายแต่ละชั้นไปยังโปรเซสย่อย
+            summaries = [process_file_by_story(executor, path, output_path_for(path), **options) for path in paths]
+
+    summary_df = pd.DataFrame(summaries, columns=SUMMARY_COLS)
+    summary_df = summary_df.sort_values('file').reset_index(drop=True)
+    summary_df.to_csv(os.path.join(output_dir, 'summary.csv'), index=False)
+    return summary_df
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="คำนวณ Load Combination จากไฟล์ ETABS หลายไฟล์โดยไม่ใช้หน้าเว็บ")
+    parser.add_argument('input_dir', help="โฟลเดอร์ที่มีไฟล์ CSV ที่ export จาก ETABS")
+    parser.add_argument('--mode', choices=['Column', 'Wall', 'Reaction'], required=True)
+    parser.add_argument('--coords', help="ไฟล์พิกัด (UniqueName, X, Y, Z) สำหรับโหมด Reaction")
+    parser.add_argument('--dead', type=float, default=1.0, help="Factor for Dead Load (โหมด Reaction)")
+    parser.add_argument('--sdl', type=float, default=1.0, help="Factor for SDL (โหมด Reaction)")
+    parser.add_argument('--live', type=float, default=1.0, help="Factor for Live Load (โหมด Reaction)")
+    parser.add_argument('--envelope', action='store_true', help="บันทึกเฉพาะค่า Max/Min ของแต่ละชิ้นส่วน")
+    parser.add_argument('--downcast', action='store_true', help="อ่านค่าแรงเป็น float32")
+    parser.add_argument('--output-dir', help="โฟลเดอร์ผลลัพธ์ (ค่าเริ่มต้น: <input_dir>/results)")
+    parser.add_argument('--workers', type=int, default=None, help="จำนวนโปรเซส (ค่าเริ่มต้น: จำนวนคอร์)")
+    parser.add_argument('--partition', choices=['file', 'story'], default='file',
+                        help="แบ่งงานตามไฟล์ หรือตามชั้น (Story) สำหรับไฟล์ขนาดใหญ่ไม่กี่ไฟล์")
+    parser.add_argument('--pattern', default='*.csv', help="รูปแบบชื่อไฟล์ที่จะประมวลผล (รองรับ .csv, .parquet, .feather)")
+    parser.add_argument('--format', choices=list(OUTPUT_FORMATS), default='csv', dest='output_format',
+                        help="รูปแบบไฟล์ผลลัพธ์")
+    parser.add_argument('--rules', help="ไฟล์ JSON กฎการสร้างชุด Combination (100/30, แรงเยื้องศูนย์) แทน U01-U09")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    pre_combo_factors = {'Dead': args.dead, 'SDL': args.sdl, 'Live': args.live}
+    combination_set = load_combination_rules(args.rules) if args.rules else STANDARD_COMBINATION_SET
+    summary_df = run_batch(
+        args.input_dir, args.mode, output_dir=args.output_dir, coords_path=args.coords,
+        pre_combo_factors=pre_combo_factors, envelope=args.envelope, downcast=args.downcast,
+        workers=args.workers, partition=args.partition, pattern=args.pattern, output_format=args.output_format,
+        combination_set=combination_set,
+    )
+    print(summary_df.to_string(index=False) if not summary_df.empty else "ไม่พบไฟล์ที่ตรงกับรูปแบบ")
+    return 1 if (not summary_df.empty and (summary_df['status'] != 'ok').any()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
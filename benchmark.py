@@ -0,0 +1,231 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from load_combination import (
+    LOAD_CASES, MEMBER_VALUE_COLS, REACTION_VALUE_COLS, Profiler, build_case_matrix_profiled, calculate_combinations,
+    calculate_reaction_combinations, get_group_cols, get_required_cols, get_value_cols, read_load_table,
+    serialize_result,
+)
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000, 10_000_000]
+EXTRA_CASES = ['Modal', 'Wind X', 'Wind Y']
+STATIONS = [0.0, 1.5, 3.0]
+WALL_LOCATIONS = ['Top', 'Bottom']
+
+
+# --- ตัวสร้างข้อมูล ETABS สังเคราะห์ (สร้างแบบเวกเตอร์ จึงสร้าง 10 ล้านแถวได้ในไม่กี่วินาที) ---
+def get_case_list(extra_cases=len(EXTRA_CASES)):
+    return LOAD_CASES + EXTRA_CASES[:extra_cases]
+
+
+def split_row_target(n_rows, rows_per_element):
+    # แบ่งจำนวนแถวเป้าหมายเป็น จำนวนชั้น x จำนวนชิ้นส่วนต่อชั้น ให้ใกล้เคียงอาคารจริง
+    n_elements = max(1, math.ceil(n_rows / rows_per_element))
+    n_stories = int(np.clip(round(math.sqrt(n_elements) / 4), 1, 120))
+    return n_stories, math.ceil(n_elements / n_stories)
+
+
+def build_element_table(keys, n_cases, cases, value_cols, rng):
+    n_rows = len(next(iter(keys.values()))) * n_cases
+    data = {col: np.repeat(values, n_cases) for col, values in keys.items()}
+    data['Output Case'] = np.tile(np.asarray(cases, dtype=object), n_rows // n_cases)
+    for col in value_cols:
+        data[col] = rng.normal(scale=100.0, size=n_rows).round(4)
+    return pd.DataFrame(data)
+
+
+def generate_column_table(n_stories, n_columns, stations=STATIONS, extra_cases=len(EXTRA_CASES), seed=0):
+    rng = np.random.default_rng(seed)
+    cases = get_case_list(extra_cases)
+    story_idx = np.repeat(np.arange(n_stories), n_columns * len(stations))
+    column_idx = np.tile(np.repeat(np.arange(n_columns), len(stations)), n_stories)
+    keys = {
+        'Story': np.char.add('Story', (n_stories - story_idx).astype(str)).astype(object),
+        'Column': np.char.add('C', (column_idx + 1).astype(str)).astype(object),
+        'Unique Name': story_idx * n_columns + column_idx + 1,
+        'Station': np.tile(np.asarray(stations, dtype=np.float64), n_stories * n_columns),
+    }
+    return build_element_table(keys, len(cases), cases, MEMBER_VALUE_COLS, rng)
+
+
+def generate_wall_table(n_stories, n_piers, extra_cases=len(EXTRA_CASES), seed=0):
+    rng = np.random.default_rng(seed)
+    cases = get_case_list(extra_cases)
+    story_idx = np.repeat(np.arange(n_stories), n_piers * len(WALL_LOCATIONS))
+    pier_idx = np.tile(np.repeat(np.arange(n_piers), len(WALL_LOCATIONS)), n_stories)
+    keys = {
+        'Story': np.char.add('Story', (n_stories - story_idx).astype(str)).astype(object),
+        'Pier': np.char.add('P', (pier_idx + 1).astype(str)).astype(object),
+        'Location': np.tile(np.asarray(WALL_LOCATIONS, dtype=object), n_stories * n_piers),
+    }
+    return build_element_table(keys, len(cases), cases, MEMBER_VALUE_COLS, rng)
+
+
+def generate_reaction_tables(n_joints, extra_cases=len(EXTRA_CASES), seed=0, spacing=8.0):
+    rng = np.random.default_rng(seed)
+    cases = get_case_list(extra_cases)
+    joint_ids = np.arange(1, n_joints + 1)
+    keys = {'Story': np.full(n_joints, 'Base', dtype=object), 'Unique Name': joint_ids}
+    df_load = build_element_table(keys, len(cases), cases, REACTION_VALUE_COLS, rng)
+    # เสาวางเป็นตารางกริด ระยะห่างประมาณ spacing เมตร
+    n_grid = math.ceil(math.sqrt(n_joints))
+    df_coords = pd.DataFrame({
+        'UniqueName': joint_ids,
+        'X': ((joint_ids - 1) % n_grid) * spacing,
+        'Y': ((joint_ids - 1) // n_grid) * spacing,
+        'Z': 0.0,
+    })
+    return df_load, df_coords
+
+
+def generate_dataset(mode, n_rows, extra_cases=len(EXTRA_CASES), seed=0):
+    n_cases = len(get_case_list(extra_cases))
+    if mode == 'Column':
+        n_stories, n_columns = split_row_target(n_rows, n_cases * len(STATIONS))
+        return generate_column_table(n_stories, n_columns, extra_cases=extra_cases, seed=seed), None
+    if mode == 'Wall':
+        n_stories, n_piers = split_row_target(n_rows, n_cases * len(WALL_LOCATIONS))
+        return generate_wall_table(n_stories, n_piers, extra_cases=extra_cases, seed=seed), None
+    return generate_reaction_tables(max(1, math.ceil(n_rows / n_cases)), extra_cases=extra_cases, seed=seed)
+
+
+# --- การจับเวลาแต่ละขั้นตอน (เรียกฟังก์ชันเดียวกับหน้าเว็บ จึงวัดเวลาและหน่วยความจำของโค้ดที่ใช้งานจริง) ---
+def write_dataset(mode, n_rows, work_dir, extra_cases=len(EXTRA_CASES), seed=0):
+    df_input, df_coords = generate_dataset(mode, n_rows, extra_cases=extra_cases, seed=seed)
+    input_path = os.path.join(work_dir, f'{mode.lower()}_{n_rows}.csv')
+    df_input.to_csv(input_path, index=False)
+    coords_path = None
+    if df_coords is not None:
+        coords_path = os.path.join(work_dir, f'{mode.lower()}_{n_rows}_coords.csv')
+        df_coords.to_csv(coords_path, index=False)
+    return input_path, coords_path
+
+
+def benchmark_pipeline(mode, n_rows, input_path, coords_path, chunksize):
+    profiler = Profiler(mode=mode, rows=n_rows)
+    df_coords = pd.read_csv(coords_path) if coords_path else None
+    df, _ = read_load_table(input_path, get_required_cols(mode), chunksize=chunksize, profiler=profiler)
+    case_matrix = build_case_matrix_profiled(df, get_group_cols(mode), get_value_cols(mode), profiler, mode)
+    del df
+
+    # Envelope คำนวณด้วย Profiler แยก แล้วเก็บเฉพาะขั้นตอน envelope (merge ของ Reaction จะได้ไม่ซ้ำชื่อกับผลลัพธ์หลัก)
+    envelope_profiler = Profiler(mode=mode, rows=n_rows)
+    if mode == 'Reaction':
+        factors = {'Dead': 1.0, 'SDL': 1.0, 'Live': 1.0}
+        result_df = calculate_reaction_combinations(
+            None, df_coords, factors, case_matrix=case_matrix, profiler=profiler
+        )
+        calculate_reaction_combinations(
+            None, df_coords, factors, envelope=True, case_matrix=case_matrix, profiler=envelope_profiler
+        )
+    else:
+        result_df = calculate_combinations(None, mode=mode, case_matrix=case_matrix, profiler=profiler)
+        calculate_combinations(None, mode=mode, envelope=True, case_matrix=case_matrix, profiler=envelope_profiler)
+    profiler.records += [r for r in envelope_profiler.records if r['stage'] == 'envelope']
+
+    with profiler.stage('serialize', rows_in=len(result_df)):
+        serialize_result(result_df, 'csv')
+    return [{k: v for k, v in r.items() if k != 'pipeline'} for r in profiler.records]
+
+
+# --- บันทึก/เปรียบเทียบ baseline ---
+def environment_info():
+    return {
+        'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+        'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+    }
+
+
+def compare_with_baseline(records, baseline, tolerance, min_seconds, memory_tolerance=0.25, min_memory_mb=50.0):
+    baseline_records = {(r['mode'], r['rows'], r['stage']): r for r in baseline['results']}
+    regressions = []
+    for record in records:
+        base = baseline_records.get((record['mode'], record['rows'], record['stage']))
+        if base is None:
+            continue
+        # ขั้นตอนที่เร็วมากมีความคลาดเคลื่อนของการจับเวลาสูง จึงไม่นับ
+        if record['seconds'] > max(base['seconds'] * (1 + tolerance), min_seconds):
+            regressions.append(dict(record, metric='seconds', baseline=base['seconds'], value=record['seconds']))
+        base_peak, peak = base.get('peak_memory_mb'), record.get('peak_memory_mb')
+        if base_peak is not None and peak is not None \
+                and peak > max(base_peak * (1 + memory_tolerance), base_peak + min_memory_mb):
+            regressions.append(dict(record, metric='peak_memory_mb', baseline=base_peak, value=peak))
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="วัดเวลาและหน่วยความจำของแต่ละขั้นตอนด้วยข้อมูล ETABS สังเคราะห์")
+    parser.add_argument('--modes', nargs='+', choices=['Column', 'Wall', 'Reaction'], default=['Column', 'Wall', 'Reaction'])
+    parser.add_argument('--rows', nargs='+', type=int, default=DEFAULT_SIZES, help="จำนวนแถวของไฟล์ input")
+    parser.add_argument('--extra-cases', type=int, default=len(EXTRA_CASES),
+                        help="จำนวน Output Case ที่ไม่ใช้ (Modal, Wind) ที่ปนอยู่ในไฟล์")
+    parser.add_argument('--chunksize', type=int, default=500_000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_results.json', help="ไฟล์ JSON ผลลัพธ์")
+    parser.add_argument('--compare', help="ไฟล์ baseline JSON ที่จะเปรียบเทียบ")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="ยอมให้ช้ากว่า baseline ได้กี่เท่า (0.25 = 25%%)")
+    parser.add_argument('--min-seconds', type=float, default=0.05, help="ไม่นับขั้นตอนที่ใช้เวลาน้อยกว่านี้")
+    parser.add_argument('--memory-tolerance', type=float, default=0.25,
+                        help="ยอมให้หน่วยความจำสูงสุดมากกว่า baseline ได้กี่เท่า (0.25 = 25%%)")
+    parser.add_argument('--min-memory-mb', type=float, default=50.0, help="ไม่นับหน่วยความจำที่เพิ่มน้อยกว่านี้ (MB)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    records = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for mode in args.modes:
+            for n_rows in args.rows:
+                input_path, coords_path = write_dataset(
+                    mode, n_rows, work_dir, extra_cases=args.extra_cases, seed=args.seed
+                )
+                # แต่ละชุดรันในโปรเซสใหม่ หน่วยความจำสูงสุด (ru_maxrss) จึงไม่ติดค่าจากชุดก่อนหน้าที่ใหญ่กว่า
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                    stage_records = executor.submit(
+                        benchmark_pipeline, mode, n_rows, input_path, coords_path, args.chunksize
+                    ).result()
+                for path in (input_path, coords_path):
+                    if path:
+                        os.remove(path)
+                total = sum(r['seconds'] for r in stage_records)
+                print(f"{mode:<8} {n_rows:>11,} rows  total {total:8.3f}s  "
+                      + "  ".join(f"{r['stage']} {r['seconds']:.3f}s" for r in stage_records))
+                records += stage_records
+
+    report = {
+        'generated_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'environment': environment_info(),
+        'results': records,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"บันทึกผลลัพธ์ที่ {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(
+            records, baseline, args.tolerance, args.min_seconds, args.memory_tolerance, args.min_memory_mb
+        )
+        for r in regressions:
+            print(f"แย่ลง: {r['mode']} {r['rows']:,} rows {r['stage']} {r['metric']}: {r['baseline']:,.3f} -> {r['value']:,.3f}")
+        if regressions:
+            return 1
+        print("ไม่พบขั้นตอนที่ช้ากว่าหรือใช้หน่วยความจำมากกว่า baseline")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
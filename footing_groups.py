@@ -0,0 +1,224 @@
+import numpy as np
+import pandas as pd
+
+from load_combination import (
+    NULL_PROFILER, REACTION_FACTOR_COLS, REACTION_VALUE_COLS, STANDARD_COMBINATION_SET, scale_case_values,
+)
+
+UNGROUPED = ''
+
+
+# --- ดัชนีเชิงพื้นที่แบบกริด (Grid hash) ของตำแหน่งจุดรองรับ ---
+class JointGridIndex:
+    def __init__(self, xy, cell_size):
+        if cell_size <= 0:
+            raise ValueError("cell_size must be positive")
+        self.xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+        self.cell_size = float(cell_size)
+        self.origin = self.xy.min(axis=0) if len(self.xy) else np.zeros(2)
+        cells = np.floor((self.xy - self.origin) / self.cell_size).astype(np.int64)
+        self.n_cols = int(cells[:, 0].max()) + 1 if len(cells) else 1
+        self.n_rows = int(cells[:, 1].max()) + 1 if len(cells) else 1
+        keys = cells[:, 0] * (self.n_rows + 2) + cells[:, 1]
+        self.order = np.argsort(keys, kind='stable')
+        self.cell_keys, self.cell_start, self.cell_count = np.unique(
+            keys[self.order], return_index=True, return_counts=True
+        )
+
+    def _cell_members(self, cell_pos):
+        # คืนดัชนีจุดทั้งหมดในเซลล์ที่กำหนด พร้อมตำแหน่งเซลล์ต้นทางของแต่ละจุด
+        counts = self.cell_count[cell_pos]
+        owner = np.repeat(np.arange(len(cell_pos)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return owner, self.order[self.cell_start[cell_pos][owner] + offsets]
+
+    def neighbor_pairs(self, radius):
+        # คู่จุดที่ห่างกันไม่เกิน radius ตรวจเฉพาะเซลล์ข้างเคียง ไม่ต้องเทียบทุกคู่
+        if radius > self.cell_size:
+            raise ValueError("radius must not exceed the index cell size")
+        stride = self.n_rows + 2
+        pairs_i, pairs_j = [], []
+        # ครึ่งหนึ่งของเซลล์ข้างเคียง 8 เซลล์ก็พอ เพราะคู่ (a, b) และ (b, a) เป็นคู่เดียวกัน
+        for dx, dy in [(0, 0), (1, -1), (1, 0), (1, 1), (0, 1)]:
+            target = self.cell_keys + dx * stride + dy
+            pos = np.searchsorted(self.cell_keys, target)
+            pos = np.minimum(pos, len(self.cell_keys) - 1)
+            found = np.flatnonzero(self.cell_keys[pos] == target)
+            if len(found) == 0:
+                continue
+            src_cells, dst_cells = found, pos[found]
+            # ทุกจุดในเซลล์ต้นทาง x ทุกจุดในเซลล์ปลายทาง
+            src_owner, src_points = self._cell_members(src_cells)
+            pair_counts = self.cell_count[dst_cells][src_owner]
+            left = np.repeat(src_points, pair_counts)
+            dst_owner = np.repeat(src_owner, pair_counts)
+            offsets = np.arange(pair_counts.sum()) - np.repeat(np.cumsum(pair_counts) - pair_counts, pair_counts)
+            right = self.order[self.cell_start[dst_cells][dst_owner] + offsets]
+            keep = left < right if (dx, dy) == (0, 0) else np.ones(len(left), dtype=bool)
+            dist2 = ((self.xy[left] - self.xy[right]) ** 2).sum(axis=1)
+            keep &= dist2 <= radius ** 2
+            pairs_i.append(left[keep])
+            pairs_j.append(right[keep])
+        if not pairs_i:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        return np.concatenate(pairs_i), np.concatenate(pairs_j)
+
+    def query_bbox(self, xmin, ymin, xmax, ymax):
+        # ตรวจเฉพาะเซลล์ที่ทับกรอบสี่เหลี่ยม: เซลล์ในคอลัมน์เดียวกันมีคีย์ต่อเนื่องกัน จึงหาด้วย searchsorted ได้
+        stride = self.n_rows + 2
+        (cx0, cy0), (cx1, cy1) = np.floor((np.array([[xmin, ymin], [xmax, ymax]]) - self.origin) / self.cell_size)
+        cx0, cx1 = max(int(cx0), 0), min(int(cx1), self.n_cols - 1)
+        cy0, cy1 = max(int(cy0), 0), min(int(cy1), self.n_rows - 1)
+        if cx0 > cx1 or cy0 > cy1:
+            return np.empty(0, dtype=np.int64)
+        column_keys = np.arange(cx0, cx1 + 1) * stride
+        first = np.searchsorted(self.cell_keys, column_keys + cy0, side='left')
+        last = np.searchsorted(self.cell_keys, column_keys + cy1, side='right')
+        cell_pos = np.concatenate([np.arange(a, b) for a, b in zip(first, last)])
+        _, candidates = self._cell_members(cell_pos)
+        xy = self.xy[candidates]
+        inside = (xy[:, 0] >= xmin) & (xy[:, 0] <= xmax) & (xy[:, 1] >= ymin) & (xy[:, 1] <= ymax)
+        return np.sort(candidates[inside])
+
+
+def connected_components(n_points, pairs_i, pairs_j):
+    # ส่งต่อ label ที่น้อยที่สุดผ่านคู่จุดจนไม่มีการเปลี่ยนแปลง (แบบเวกเตอร์)
+    labels = np.arange(n_points)
+    while True:
+        edge_min = np.minimum(labels[pairs_i], labels[pairs_j])
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, pairs_i, edge_min)
+        np.minimum.at(new_labels, pairs_j, edge_min)
+        new_labels = new_labels[new_labels]
+        if np.array_equal(new_labels, labels):
+            return np.unique(labels, return_inverse=True)[1]
+        labels = new_labels
+
+
+def points_in_polygon(xy, vertices):
+    # Ray casting: นับจำนวนครั้งที่เส้นจากจุดไปทางขวาตัดขอบรูปหลายเหลี่ยม
+    x, y = xy[:, 0:1], xy[:, 1:2]
+    x1, y1 = vertices[:, 0], vertices[:, 1]
+    x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+    crosses = (y1 > y) != (y2 > y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_cross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+    return (crosses & (x < x_cross)).sum(axis=1) % 2 == 1
+
+
+# --- การจัดกลุ่มจุดรองรับ ---
+def group_by_radius(xy, radius):
+    if len(xy) == 0:
+        return np.empty(0, dtype=np.int64)
+    index = JointGridIndex(xy, cell_size=radius)
+    pairs_i, pairs_j = index.neighbor_pairs(radius)
+    return connected_components(len(xy), pairs_i, pairs_j)
+
+
+def group_by_polygons(xy, df_polygons):
+    # df_polygons: คอลัมน์ Group, X, Y เรียงตามลำดับจุดยอดของแต่ละรูป
+    group_names = np.full(len(xy), UNGROUPED, dtype=object)
+    if len(xy) == 0:
+        return group_names
+    index = JointGridIndex(xy, cell_size=max(np.ptp(xy, axis=0).max() / 64, 1e-6))
+    # แบ่งจุดยอดตามกลุ่มด้วย numpy (วนผ่าน groupby ของ pandas ช้ากว่ามากเมื่อมีฐานรากหลายพันรูป)
+    codes, names = pd.factorize(df_polygons['Group'], sort=False)
+    order = np.flatnonzero(codes >= 0)
+    order = order[np.argsort(codes[order], kind='stable')]
+    all_vertices = df_polygons[['X', 'Y']].to_numpy(dtype=np.float64)[order]
+    bounds = np.flatnonzero(np.diff(codes[order])) + 1
+    for name, vertices in zip(names, np.split(all_vertices, bounds)):
+        candidates = index.query_bbox(*vertices.min(axis=0), *vertices.max(axis=0))
+        candidates = candidates[group_names[candidates] == UNGROUPED]
+        inside = candidates[points_in_polygon(index.xy[candidates], vertices)]
+        group_names[inside] = str(name)
+    return group_names
+
+
+def assign_joint_groups(keys_df, df_coords, radius=None, df_polygons=None):
+    coords = df_coords.rename(columns={'UniqueName': 'Unique Name'})
+    coords = coords[['Unique Name', 'X', 'Y', 'Z']].drop_duplicates(subset=['Unique Name'])
+    membership = pd.merge(keys_df, coords, on='Unique Name', how='left')
+    has_coords = membership[['X', 'Y']].notna().all(axis=1).to_numpy()
+    xy = membership.loc[has_coords, ['X', 'Y']].to_numpy(dtype=np.float64)
+
+    groups = np.full(len(membership), UNGROUPED, dtype=object)
+    if df_polygons is not None:
+        groups[has_coords] = group_by_polygons(xy, df_polygons)
+    elif radius is not None:
+        labels = group_by_radius(xy, radius)
+        groups[has_coords] = np.char.add('G', (labels + 1).astype(str)).astype(object)
+    else:
+        raise ValueError("Either radius or df_polygons is required")
+
+    # จุดที่ไม่อยู่ในกลุ่มใดเป็นฐานรากเดี่ยว ตั้งชื่อกลุ่มเป็น J + ชื่อจุด (แยกจากชื่อกลุ่มรูปหลายเหลี่ยม)
+    single = has_coords & (groups == UNGROUPED)
+    single_names = np.char.add('J', membership.loc[single, 'Unique Name'].astype(str).to_numpy().astype(str))
+    clashes = set(groups[has_coords & ~single]) & set(single_names)
+    if clashes:
+        raise ValueError(f"Group names clash with single-footing names: {', '.join(sorted(clashes)[:5])}")
+    groups[single] = single_names.astype(object)
+    membership['Group'] = groups
+    membership.loc[~has_coords, 'Group'] = np.nan
+    return membership
+
+
+# --- แรงลัพธ์ของกลุ่มรอบจุดศูนย์กลางกลุ่ม (ทุก Combination ในครั้งเดียว) ---
+def calculate_group_resultants(case_matrix, df_coords, pre_combo_factors, radius=None, df_polygons=None,
+                               profiler=NULL_PROFILER, combination_set=STANDARD_COMBINATION_SET):
+    keys_df, values = case_matrix
+    with profiler.stage('group', pipeline='Footing', rows_in=len(keys_df)) as record:
+        membership = assign_joint_groups(keys_df, df_coords, radius=radius, df_polygons=df_polygons)
+        record['rows_out'] = membership['Group'].nunique()
+
+    with profiler.stage('resultant', pipeline='Footing', rows_in=len(keys_df)) as record:
+        grouped = membership['Group'].notna().to_numpy()
+        group_names, group_ids = np.unique(membership.loc[grouped, 'Group'].astype(str), return_inverse=True)
+        n_groups = len(group_names)
+        # np.array คัดลอกเสมอ (to_numpy อาจคืน view แบบอ่านอย่างเดียวภายใต้ copy-on-write)
+        xyz = np.array(membership.loc[grouped, ['X', 'Y', 'Z']], dtype=np.float64)
+        xyz[:, 2] = np.nan_to_num(xyz[:, 2])
+        counts = np.bincount(group_ids, minlength=n_groups)
+        centroid = np.stack(
+            [np.bincount(group_ids, weights=xyz[:, k], minlength=n_groups) for k in range(3)], axis=1
+        ).astype(np.float64)
+        centroid /= counts[:, None]
+        arm = xyz - centroid[group_ids]
+
+        names, coeffs = combination_set.coefficients(REACTION_VALUE_COLS)
+        joint_values = scale_case_values(
+            values[grouped], pre_combo_factors, REACTION_VALUE_COLS, REACTION_FACTOR_COLS, combination_set.cases
+        )
+        # (Combination x จุด x ค่าแรง)
+        forces = np.einsum('ekc,nkc->nec', joint_values, coeffs)
+        fx, fy, fz, mx, my, mz = (forces[:, :, j] for j in range(6))
+        rx, ry, rz = arm[:, 0], arm[:, 1], arm[:, 2]
+        # M_group = sum(M_i + r_i x F_i)
+        contributions = np.stack([
+            fx, fy, fz,
+            mx + ry * fz - rz * fy,
+            my + rz * fx - rx * fz,
+            mz + rx * fy - ry * fx,
+        ], axis=2)
+
+        n_combos = len(names)
+        flat_ids = (np.arange(n_combos)[:, None] * n_groups + group_ids[None, :]).ravel()
+        totals = np.stack([
+            np.bincount(flat_ids, weights=contributions[:, :, j].ravel(), minlength=n_combos * n_groups)
+            for j in range(len(REACTION_VALUE_COLS))
+        ], axis=1)
+
+        group_df = pd.DataFrame({
+            'Group': np.tile(group_names, n_combos),
+            'Joints': np.tile(counts, n_combos),
+            'Xc': np.tile(centroid[:, 0], n_combos),
+            'Yc': np.tile(centroid[:, 1], n_combos),
+            'Zc': np.tile(centroid[:, 2], n_combos),
+            'Output Case': np.repeat(np.asarray(names, dtype=object), n_groups),
+        })
+        group_df[REACTION_VALUE_COLS] = totals.round(4)
+        group_df[['Xc', 'Yc', 'Zc']] = group_df[['Xc', 'Yc', 'Zc']].round(4)
+        record['rows_out'] = len(group_df)
+
+    membership = membership[['Story', 'Unique Name', 'X', 'Y', 'Z', 'Group']]
+    return group_df, membership
@@ -0,0 +1,1302 @@
+import pandas as pd
+import numpy as np
+import os
+import sys
+import hashlib
+import threading
+import time
+import io
+import json
+import logging
+import gzip
+import shutil
+import zipfile
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# --- ค่าคงที่ที่ใช้ร่วมกันทุกโหมด ---
+LOAD_CASES = ['Dead', 'SDL', 'Live', 'EX', 'EY']
+SEISMIC_CASES = ['EX', 'EY']
+SEISMIC_AMPLIFIER = 2.5
+
+COMBINATIONS = {
+    'U01': {'Dead': 1.4, 'SDL': 1.4, 'Live': 1.7}, 'U02': {'Dead': 1.05, 'SDL': 1.05, 'Live': 1.275, 'EX': 1},
+    'U03': {'Dead': 1.05, 'SDL': 1.05, 'Live': 1.275, 'EX': -1}, 'U04': {'Dead': 1.05, 'SDL': 1.05, 'Live': 1.275, 'EY': 1},
+    'U05': {'Dead': 1.05, 'SDL': 1.05, 'Live': 1.275, 'EY': -1}, 'U06': {'Dead': 0.9, 'SDL': 0.9, 'EX': 1},
+    'U07': {'Dead': 0.9, 'SDL': 0.9, 'EX': -1}, 'U08': {'Dead': 0.9, 'SDL': 0.9, 'EY': 1},
+    'U09': {'Dead': 0.9, 'SDL': 0.9, 'EY': -1},
+}
+
+MEMBER_VALUE_COLS = ['P', 'V2', 'V3', 'T', 'M2', 'M3']
+MEMBER_AMPLIFIED_COLS = ['V2', 'V3']
+REACTION_VALUE_COLS = ['FX', 'FY', 'FZ', 'MX', 'MY', 'MZ']
+REACTION_AMPLIFIED_COLS = ['FX', 'FY']
+REACTION_FACTOR_COLS = ['FZ', 'MX', 'MY', 'MZ']
+GRAVITY_CASES = ['Dead', 'SDL', 'Live']
+
+# กฎสำหรับสร้างชุด Combination แผ่นดินไหว: กฎนี้ให้ผลเหมือน U01-U09 ทุกประการ
+# ตั้ง 'orthogonal': 0.3 สำหรับกฎ 100/30 และใส่หลาย Load Case ต่อทิศทางสำหรับแรงเยื้องศูนย์ (เช่น ['EXP', 'EXN'])
+STANDARD_RULES = {
+    'prefix': 'U',
+    'gravity': [{'Dead': 1.4, 'SDL': 1.4, 'Live': 1.7}],
+    'seismic_gravity': [{'Dead': 1.05, 'SDL': 1.05, 'Live': 1.275}, {'Dead': 0.9, 'SDL': 0.9}],
+    'directions': {'X': ['EX'], 'Y': ['EY']},
+    'primary': 1.0,
+    'orthogonal': 0.0,
+    'sign_flips': True,
+    'amplifier': {col: SEISMIC_AMPLIFIER for col in MEMBER_AMPLIFIED_COLS + REACTION_AMPLIFIED_COLS},
+}
+
+CATEGORICAL_COLS = ['Story', 'Column', 'Pier', 'Location', 'Unique Name', 'Output Case']
+CSV_CHUNK_ROWS = 500_000
+CACHE_BUDGET_MB = float(os.environ.get('LOAD_COMBO_CACHE_MB', 1024))
+# คลังเมทริกซ์บนดิสก์: ตั้ง LOAD_COMBO_STORE_DIR เป็นค่าว่างเพื่อปิด
+STORE_DIR = os.environ.get('LOAD_COMBO_STORE_DIR', 'model_store')
+STORE_BUDGET_MB = float(os.environ.get('LOAD_COMBO_STORE_MB', 4096))
+JOB_WORKERS = int(os.environ.get('LOAD_COMBO_JOB_WORKERS', min(4, os.cpu_count() or 1)))
+
+INPUT_TYPES = ['csv', 'parquet', 'feather']
+RESULT_INDEX_COLS = ['Story', 'Column', 'Pier', 'Unique Name', 'Output Case', 'Metric', 'Group', 'Change']
+REVISION_CHANGES = ['added', 'removed', 'changed', 'unchanged']
+# รูปแบบไฟล์ผลลัพธ์: นามสกุลไฟล์, MIME type
+OUTPUT_FORMATS = {
+    'csv': ('.csv', 'text/csv'),
+    'csv.gz': ('.csv.gz', 'application/gzip'),
+    'zip': ('.zip', 'application/zip'),
+    'parquet': ('.parquet', 'application/vnd.apache.parquet'),
+    'feather': ('.feather', 'application/vnd.apache.arrow.file'),
+}
+
+
+def get_group_cols(mode):
+    if mode == 'Column':
+        return ['Story', 'Column', 'Unique Name', 'Station']
+    if mode == 'Wall':
+        return ['Story', 'Pier', 'Location']
+    return ['Story', 'Unique Name']
+
+
+def get_element_cols(mode):
+    # ชิ้นส่วนหนึ่งชิ้นไม่แยกตามตำแหน่งตามความยาว (Station ของเสา, Top/Bottom ของกำแพง)
+    if mode == 'Column':
+        return ['Story', 'Column', 'Unique Name']
+    if mode == 'Wall':
+        return ['Story', 'Pier']
+    return ['Story', 'Unique Name']
+
+
+def get_value_cols(mode):
+    return REACTION_VALUE_COLS if mode == 'Reaction' else MEMBER_VALUE_COLS
+
+
+def get_required_cols(mode):
+    return set(get_group_cols(mode)) | {'Output Case'} | set(get_value_cols(mode))
+
+
+# --- ส่วนของการวัดเวลาและหน่วยความจำแต่ละขั้นตอน (ปิดไว้ = แทบไม่มีค่าใช้จ่าย) ---
+logger = logging.getLogger('load_combination')
+
+
+def get_peak_memory_mb():
+    if resource is None:
+        return None
+    # Linux รายงาน ru_maxrss เป็น KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def get_current_memory_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except (OSError, ValueError, AttributeError):
+        return get_peak_memory_mb()
+
+
+class Profiler:
+    def __init__(self, enabled=True, **context):
+        self.enabled = enabled
+        self.context = context
+        self.records = []
+
+    @contextmanager
+    def stage(self, name, pipeline='', rows_in=None):
+        # ผู้เรียกกำหนด record['rows_out'] ภายในบล็อก with ได้
+        if not self.enabled:
+            yield {}
+            return
+        record = dict(self.context, pipeline=pipeline, stage=name, rows_in=rows_in, rows_out=None)
+        memory_before = get_current_memory_mb()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = round(time.perf_counter() - start, 4)
+            memory_after = get_current_memory_mb()
+            if memory_before is not None and memory_after is not None:
+                record['memory_delta_mb'] = round(memory_after - memory_before, 1)
+            record['peak_memory_mb'] = get_peak_memory_mb()
+            self.records.append(record)
+            logger.info(json.dumps(record, default=str, ensure_ascii=False))
+
+    def progress(self, done, total=None):
+        # ความคืบหน้าภายในขั้นตอน (เช่น จำนวนแถวที่อ่าน, จำนวน Combination ที่คำนวณแล้ว) ใช้กับงานเบื้องหลัง
+        pass
+
+    def to_frame(self):
+        return pd.DataFrame(self.records)
+
+
+NULL_PROFILER = Profiler(enabled=False)
+
+
+def enable_stage_logging(level=logging.INFO):
+    logger.setLevel(level)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(message)s'))
+        logger.addHandler(handler)
+
+
+# --- ส่วนของการอ่านไฟล์ (อ่านทีละส่วน เฉพาะคอลัมน์ที่ใช้ และกรอง Output Case ทันที) ---
+def rewind(file):
+    if hasattr(file, 'seek'):
+        file.seek(0)
+
+
+def get_file_name(file):
+    return file if isinstance(file, (str, os.PathLike)) else getattr(file, 'name', '')
+
+
+def get_table_format(file):
+    name = str(get_file_name(file)).lower()
+    if name.endswith('.parquet') or name.endswith('.pq'):
+        return 'parquet'
+    if name.endswith('.feather') or name.endswith('.arrow'):
+        return 'feather'
+    return 'csv'
+
+
+def get_file_size(file):
+    if isinstance(file, (str, os.PathLike)):
+        return os.path.getsize(file)
+    size = file.seek(0, os.SEEK_END)
+    rewind(file)
+    return size
+
+
+def import_pyarrow():
+    try:
+        import pyarrow.parquet
+        import pyarrow.ipc
+    except ImportError:
+        raise ImportError("การอ่าน/เขียนไฟล์ Parquet หรือ Feather ต้องติดตั้ง pyarrow (pip install pyarrow)")
+    return pyarrow
+
+
+def read_table_columns(file):
+    table_format = get_table_format(file)
+    if table_format == 'parquet':
+        columns = import_pyarrow().parquet.ParquetFile(file).schema_arrow.names
+    elif table_format == 'feather':
+        columns = import_pyarrow().ipc.open_file(file).schema.names
+    else:
+        columns = pd.read_csv(file, nrows=0).columns
+    rewind(file)
+    return list(columns)
+
+
+def iter_table_chunks(file, usecols, chunksize=CSV_CHUNK_ROWS):
+    # ไฟล์แบบคอลัมน์ (Parquet/Feather) อ่านทีละ batch เฉพาะคอลัมน์ที่ใช้ ไม่ต้องแปลงทั้งไฟล์
+    table_format = get_table_format(file)
+    if table_format == 'parquet':
+        parquet_file = import_pyarrow().parquet.ParquetFile(file)
+        for batch in parquet_file.iter_batches(batch_size=chunksize, columns=usecols):
+            yield batch.to_pandas()
+    elif table_format == 'feather':
+        reader = import_pyarrow().ipc.open_file(file)
+        for i in range(reader.num_record_batches):
+            yield reader.get_batch(i).select(usecols).to_pandas()
+    else:
+        yield from pd.read_csv(file, usecols=usecols, chunksize=chunksize)
+
+
+def combine_chunks(chunks, columns):
+    if not chunks:
+        return pd.DataFrame(columns=columns)
+    data = {}
+    for col in columns:
+        parts = [chunk[col] for chunk in chunks]
+        if isinstance(parts[0].dtype, pd.CategoricalDtype):
+            try:
+                data[col] = pd.api.types.union_categoricals(parts, sort_categories=True)
+            except TypeError:
+                # ชนิดข้อมูลของหมวดหมู่ต่างกันระหว่างส่วน (เช่น ตัวเลขปนตัวอักษร)
+                data[col] = pd.Categorical(np.concatenate([part.astype(object).to_numpy() for part in parts]))
+        else:
+            data[col] = np.concatenate([part.to_numpy() for part in parts])
+    return pd.DataFrame(data, columns=columns)
+
+
+def get_chunk_value_cols(columns):
+    return [col for col in columns if col not in CATEGORICAL_COLS and col != 'Station']
+
+
+def prepare_chunk(chunk, value_cols, downcast=False, cases=LOAD_CASES):
+    output_case = chunk['Output Case'].astype(str).str.strip()
+    keep = output_case.isin(cases).to_numpy()
+    chunk = chunk[keep]
+    updates = {col: pd.Categorical(chunk[col]) for col in chunk.columns if col in CATEGORICAL_COLS}
+    updates['Output Case'] = pd.Categorical(output_case[keep])
+    if downcast:
+        updates.update({col: chunk[col].astype(np.float32) for col in value_cols})
+    return chunk.assign(**updates)
+
+
+def read_load_table(file, required_cols, downcast=False, chunksize=CSV_CHUNK_ROWS, profiler=NULL_PROFILER,
+                    cases=LOAD_CASES):
+    usecols = [col for col in read_table_columns(file) if col in required_cols]
+    value_cols = get_chunk_value_cols(usecols)
+
+    stats = {'rows_read': 0, 'rows_kept': 0, 'bytes_read': get_file_size(file)}
+    chunks = []
+    with profiler.stage('read', pipeline='ingest') as record:
+        for chunk in iter_table_chunks(file, usecols, chunksize=chunksize):
+            stats['rows_read'] += len(chunk)
+            chunk = prepare_chunk(chunk, value_cols, downcast=downcast, cases=cases)
+            stats['rows_kept'] += len(chunk)
+            chunks.append(chunk)
+            profiler.progress(stats['rows_read'])
+        df = combine_chunks(chunks, usecols)
+        record.update(rows_in=stats['rows_read'], rows_out=stats['rows_kept'])
+    stats['memory_mb'] = df.memory_usage(deep=True).sum() / 1024 ** 2
+    stats['peak_memory_mb'] = get_peak_memory_mb()
+    return df, stats
+
+
+def format_read_stats(stats):
+    text = (f"อ่านไฟล์ {stats['bytes_read'] / 1024 ** 2:,.1f} MB | "
+            f"แถวทั้งหมด {stats['rows_read']:,} | เก็บไว้ {stats['rows_kept']:,} แถว "
+            f"({stats['memory_mb']:,.1f} MB ในหน่วยความจำ)")
+    if stats['peak_memory_mb'] is not None:
+        text += f" | หน่วยความจำสูงสุดของโปรเซส {stats['peak_memory_mb']:,.0f} MB"
+    return text
+
+
+# --- เครื่องคำนวณแบบเมทริกซ์ (ใช้ร่วมกันทั้ง Column, Wall และ Reaction) ---
+def format_combination_name(name, factors, cases=LOAD_CASES):
+    formula_parts = []
+    for case in cases:
+        factor_val = factors.get(case)
+        if factor_val:
+            formula_parts.append(f"{factor_val:+g}{case}")
+    formula_string = "".join(formula_parts).lstrip('+')
+    return f"{name}: {formula_string}"
+
+
+def build_case_matrix(df, group_cols, value_cols, cases=LOAD_CASES):
+    # แปลงคีย์ของชิ้นส่วนเป็นรหัสกลุ่มเพียงครั้งเดียว (เรียงลำดับเหมือน pivot_table)
+    group_ids = df.groupby(group_cols, sort=True, observed=True, dropna=True).ngroup()
+    valid = group_ids.notna().to_numpy()
+    group_ids = group_ids.to_numpy()[valid].astype(np.int64)
+    unique_ids, first_pos = np.unique(group_ids, return_index=True)
+    keys_df = df.loc[valid, group_cols].iloc[first_pos].reset_index(drop=True)
+
+    n_elements, n_cases = len(unique_ids), len(cases)
+    case_codes = pd.Categorical(df['Output Case'].to_numpy()[valid], categories=cases).codes
+    in_case = case_codes >= 0
+    flat_idx = group_ids[in_case] * n_cases + case_codes[in_case]
+    size = n_elements * n_cases
+
+    # ค่าเฉลี่ยต่อ (ชิ้นส่วน, Load Case) เหมือน pivot_table และเติม 0 เมื่อไม่มีข้อมูล
+    values = np.zeros((n_elements, n_cases, len(value_cols)), dtype=np.float64)
+    raw = df[value_cols].to_numpy(dtype=np.float64)[valid][in_case]
+    for j in range(len(value_cols)):
+        col = raw[:, j]
+        has_val = ~np.isnan(col)
+        sums = np.bincount(flat_idx[has_val], weights=col[has_val], minlength=size)
+        counts = np.bincount(flat_idx[has_val], minlength=size)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = np.where(counts > 0, sums / np.maximum(counts, 1), 0.0)
+        values[:, :, j] = means.reshape(n_elements, n_cases)
+    return keys_df, values
+
+
+def build_coefficient_tensor(combinations, value_cols, amplified_cols, cases=LOAD_CASES, seismic_cases=SEISMIC_CASES):
+    # amplified_cols: รายชื่อคอลัมน์ที่คูณ 2.5 หรือ dict {คอลัมน์: ตัวคูณ} เมื่อแต่ละค่าแรงใช้ตัวคูณต่างกัน
+    if not isinstance(amplified_cols, dict):
+        amplified_cols = {col: SEISMIC_AMPLIFIER for col in amplified_cols}
+    amplifier = np.array([amplified_cols.get(col, 1.0) for col in value_cols], dtype=np.float64)
+    names = []
+    coeffs = np.zeros((len(combinations), len(cases), len(value_cols)), dtype=np.float64)
+    for i, (name, factors) in enumerate(combinations.items()):
+        names.append(format_combination_name(name, factors, cases))
+        for k, case in enumerate(cases):
+            coeffs[i, k, :] = factors.get(case, 0)
+            if case in seismic_cases:
+                coeffs[i, k, :] *= amplifier
+    return names, coeffs
+
+
+def scale_case_values(values, case_factors, value_cols, factor_cols=None, cases=LOAD_CASES):
+    # คูณค่าแรงด้วย Factor ก่อนรวม Combination (เช่น Reaction, ชั้นใต้ดิน) บนสำเนาของเมทริกซ์
+    # ไม่รวม Factor เข้าไปในสัมประสิทธิ์: ลำดับการคูณเหมือนการคำนวณเดิม (ค่าแรง x Factor แล้วจึงคูณสัมประสิทธิ์)
+    # ชิ้นส่วนที่มีหลายแถวต่อ Load Case ถูกเฉลี่ยตอน pivot ก่อนคูณ Factor จึงอาจต่างจากเดิมที่หลักสุดท้าย
+    scaled = np.array([col in (factor_cols or value_cols) for col in value_cols])
+    factored = [(cases.index(case), factor) for case, factor in (case_factors or {}).items()
+                if case in cases and factor != 1.0]
+    if not factored:
+        return values
+    values = values.copy()
+    for k, factor in factored:
+        values[:, k, scaled] *= factor
+    return values
+
+
+def apply_combinations(keys_df, values, names, coeffs, value_cols, profiler=NULL_PROFILER):
+    # (ชิ้นส่วน x Load Case x ค่าแรง) กับ (Combination x Load Case x ค่าแรง) -> (Combination x ชิ้นส่วน x ค่าแรง)
+    n_combos, n_elements = len(names), len(keys_df)
+    combined = np.empty((n_combos, n_elements, len(value_cols)), dtype=np.result_type(values, coeffs))
+    for i in range(n_combos):
+        np.einsum('ekc,kc->ec', values, coeffs[i], out=combined[i])
+        profiler.progress(i + 1, n_combos)
+
+    result_df = keys_df.iloc[np.tile(np.arange(n_elements), n_combos)].reset_index(drop=True)
+    result_df['Output Case'] = np.repeat(np.asarray(names, dtype=object), n_elements)
+    result_values = pd.DataFrame(combined.reshape(n_combos * n_elements, len(value_cols)), columns=value_cols)
+    return pd.concat([result_df, result_values], axis=1)
+
+
+def envelope_columns(value_cols):
+    cols = []
+    for val_col in value_cols:
+        cols += [f'{val_col}_max', f'{val_col}_max_combo', f'{val_col}_min', f'{val_col}_min_combo']
+    return cols
+
+
+def apply_envelope(keys_df, values, names, coeffs, value_cols, profiler=NULL_PROFILER):
+    # ลดรูปทีละ Combination โดยไม่สร้างตารางยาว: หน่วยความจำขึ้นกับจำนวนชิ้นส่วนเท่านั้น
+    n_elements, n_vals = len(keys_df), len(value_cols)
+    max_vals = np.full((n_elements, n_vals), -np.inf)
+    min_vals = np.full((n_elements, n_vals), np.inf)
+    max_idx = np.zeros((n_elements, n_vals), dtype=np.int16)
+    min_idx = np.zeros((n_elements, n_vals), dtype=np.int16)
+
+    for i in range(len(names)):
+        combo_vals = np.einsum('ekc,kc->ec', values, coeffs[i])
+        is_max = combo_vals > max_vals
+        is_min = combo_vals < min_vals
+        np.copyto(max_vals, combo_vals, where=is_max)
+        np.copyto(min_vals, combo_vals, where=is_min)
+        max_idx[is_max] = i
+        min_idx[is_min] = i
+        profiler.progress(i + 1, len(names))
+
+    names_arr = np.asarray(names, dtype=object)
+    result_df = keys_df.copy()
+    for j, val_col in enumerate(value_cols):
+        result_df[f'{val_col}_max'] = max_vals[:, j].round(4)
+        result_df[f'{val_col}_max_combo'] = names_arr[max_idx[:, j]]
+        result_df[f'{val_col}_min'] = min_vals[:, j].round(4)
+        result_df[f'{val_col}_min_combo'] = names_arr[min_idx[:, j]]
+    return result_df
+
+
+def build_case_matrix_profiled(df, group_cols, value_cols, profiler=NULL_PROFILER, pipeline='', cases=LOAD_CASES):
+    with profiler.stage('pivot', pipeline=pipeline, rows_in=len(df)) as record:
+        keys_df, values = build_case_matrix(df, group_cols, value_cols, cases)
+        record['rows_out'] = len(keys_df)
+    return keys_df, values
+
+
+def combine_profiled(keys_df, values, names, coeffs, value_cols, envelope, profiler=NULL_PROFILER, pipeline=''):
+    stage_name = 'envelope' if envelope else 'combine'
+    with profiler.stage(stage_name, pipeline=pipeline, rows_in=len(keys_df)) as record:
+        if envelope:
+            result_df = apply_envelope(keys_df, values, names, coeffs, value_cols, profiler)
+        else:
+            result_df = apply_combinations(keys_df, values, names, coeffs, value_cols, profiler)
+        record['rows_out'] = len(result_df)
+    return result_df
+
+
+# --- ชุด Combination ที่สร้างจากกฎ (100/30, แรงเยื้องศูนย์, สลับเครื่องหมาย) ---
+def generate_combinations(rules):
+    rules = {**STANDARD_RULES, **rules}
+    directions = rules['directions']
+    if not directions or not all(directions.values()):
+        raise ValueError("Every seismic direction needs at least one load case")
+    seismic_cases = [case for cases in directions.values() for case in cases]
+    if len(set(seismic_cases)) != len(seismic_cases):
+        repeated = sorted({case for case in seismic_cases if seismic_cases.count(case) > 1})
+        raise ValueError(f"Each seismic load case may appear in only one direction, once: {', '.join(repeated)}")
+    if set(seismic_cases) & set(GRAVITY_CASES):
+        raise ValueError("Seismic load cases must not reuse Dead, SDL or Live")
+    signs = (1, -1) if rules['sign_flips'] else (1,)
+
+    combos = [dict(factors) for factors in rules['gravity']]
+    for base in rules['seismic_gravity']:
+        for direction, primary_cases in directions.items():
+            # ทิศตั้งฉากคิด 30% (หรือตามที่กำหนด) จากทุก Load Case ของทิศอื่น
+            secondary_cases = [None]
+            if rules['orthogonal']:
+                # ถ้ามีทิศเดียวจะไม่มีทิศตั้งฉาก ให้คิดเฉพาะทิศหลัก (เหมือน orthogonal = 0)
+                secondary_cases = [case for other, cases in directions.items() if other != direction for case in cases] or [None]
+            for primary_case in primary_cases:
+                for secondary_case in secondary_cases:
+                    for primary_sign in signs:
+                        for secondary_sign in (signs if secondary_case else (1,)):
+                            factors = dict(base)
+                            factors[primary_case] = primary_sign * rules['primary']
+                            if secondary_case:
+                                factors[secondary_case] = secondary_sign * rules['orthogonal']
+                            combos.append(factors)
+    width = max(2, len(str(len(combos))))
+    return {f"{rules['prefix']}{i:0{width}d}": factors for i, factors in enumerate(combos, start=1)}
+
+
+class CombinationSet:
+    def __init__(self, combinations, seismic_cases=SEISMIC_CASES, amplifier=None):
+        self.combinations = dict(combinations)
+        self.seismic_cases = list(seismic_cases)
+        self.amplifier = dict(STANDARD_RULES['amplifier'] if amplifier is None else amplifier)
+        used = {case for factors in self.combinations.values() for case in factors}
+        # ลำดับ Load Case: Dead, SDL, Live ก่อนเสมอ (ใช้กับตัวคูณชั้นใต้ดิน/Reaction) แล้วตามด้วยแรงแผ่นดินไหว
+        self.cases = list(GRAVITY_CASES) + [case for case in self.seismic_cases if case in used]
+        self.cases += sorted(used - set(self.cases))
+        self.key = (
+            tuple((name, tuple(sorted(factors.items()))) for name, factors in self.combinations.items()),
+            tuple(self.seismic_cases), tuple(sorted(self.amplifier.items())),
+        )
+        self._compiled = {}
+
+    def __len__(self):
+        return len(self.combinations)
+
+    def coefficients(self, value_cols):
+        # คอมไพล์เทนเซอร์สัมประสิทธิ์ครั้งเดียวต่อชุดค่าแรง แล้วใช้ซ้ำ
+        key = tuple(value_cols)
+        if key not in self._compiled:
+            self._compiled[key] = build_coefficient_tensor(
+                self.combinations, value_cols, self.amplifier, cases=self.cases, seismic_cases=self.seismic_cases,
+            )
+        return self._compiled[key]
+
+
+def compile_combination_rules(rules):
+    rules = {**STANDARD_RULES, **rules}
+    seismic_cases = [case for cases in rules['directions'].values() for case in cases]
+    return CombinationSet(generate_combinations(rules), seismic_cases, rules['amplifier'])
+
+
+def load_combination_rules(path):
+    with open(path, encoding='utf-8') as f:
+        return compile_combination_rules(json.load(f))
+
+
+STANDARD_COMBINATION_SET = CombinationSet(COMBINATIONS)
+
+
+# --- ส่วนของการคำนวณ (โหมด Column และ Wall) ---
+def calculate_combinations(df_input, custom_story_name=None, mode='Column', envelope=False, case_matrix=None,
+                           profiler=NULL_PROFILER, combination_set=STANDARD_COMBINATION_SET):
+    df = df_input
+    # สำหรับโหมด Column/Wall จะใช้ P, V2, V3, ...
+    value_cols = MEMBER_VALUE_COLS
+    group_cols = get_group_cols(mode)
+
+    if custom_story_name:
+        df = df.assign(Story=custom_story_name)
+
+    # case_matrix = (keys_df, values) ที่ pivot ไว้แล้ว (เช่น จากแคช) จะข้ามขั้นตอน pivot
+    if case_matrix is None:
+        case_matrix = build_case_matrix_profiled(df, group_cols, value_cols, profiler, mode, combination_set.cases)
+    keys_df, values = case_matrix
+    # เงื่อนไขพิเศษสำหรับ V2, V3 (คูณ EX, EY ด้วย 2.5) อยู่ในเทนเซอร์สัมประสิทธิ์
+    names, coeffs = combination_set.coefficients(value_cols)
+    result_df = combine_profiled(keys_df, values, names, coeffs, value_cols, envelope, profiler, mode)
+    if envelope:
+        return result_df
+
+    with profiler.stage('round', pipeline=mode, rows_in=len(result_df)):
+        result_df[value_cols] = result_df[value_cols].round(4)
+    final_cols = group_cols + ['Output Case'] + value_cols
+    return result_df[final_cols]
+
+# --- ส่วนของการคำนวณชั้นใต้ดิน (ใช้เมทริกซ์ของชั้นฐานที่ pivot ไว้แล้ว ไม่ต้องสร้างข้อมูลใหม่) ---
+def calculate_underground_combinations(case_matrix, base_story, levels, mode='Column', envelope=False,
+                                       profiler=NULL_PROFILER, combination_set=STANDARD_COMBINATION_SET):
+    # levels = {ชื่อชั้น: {'Dead': f, 'SDL': f, 'Live': f}} คำนวณหลายชั้นพร้อมกันได้ในครั้งเดียว
+    value_cols = MEMBER_VALUE_COLS
+    group_cols = get_group_cols(mode)
+    keys_df, values = case_matrix
+    in_base = (keys_df['Story'] == base_story).to_numpy()
+    base_keys = keys_df[in_base].reset_index(drop=True)
+    base_values = values[in_base]
+
+    level_dfs = []
+    for story_name, level_factors in levels.items():
+        # Factor ของชั้นใต้ดินคูณกับเมทริกซ์ของชั้นฐาน (เฉพาะชิ้นส่วนของชั้นนั้น) ไม่ต้องอ่านหรือ pivot ใหม่
+        names, coeffs = combination_set.coefficients(value_cols)
+        level_values = scale_case_values(base_values, level_factors, value_cols, cases=combination_set.cases)
+        level_keys = base_keys.assign(Story=story_name)
+        level_dfs.append(
+            combine_profiled(level_keys, level_values, names, coeffs, value_cols, envelope, profiler, 'Underground')
+        )
+
+    result_df = pd.concat(level_dfs, ignore_index=True)
+    if envelope:
+        return result_df
+    with profiler.stage('round', pipeline='Underground', rows_in=len(result_df)):
+        result_df[value_cols] = result_df[value_cols].round(4)
+    final_cols = group_cols + ['Output Case'] + value_cols
+    return result_df[final_cols]
+
+# --- <<<<<<<<<<<<<<<<<<<< ฟังก์ชันใหม่สำหรับ Mode Reaction <<<<<<<<<<<<<<<<<<<< ---
+def calculate_reaction_combinations(df_load, df_coords, pre_combo_factors, envelope=False, case_matrix=None,
+                                    profiler=NULL_PROFILER, combination_set=STANDARD_COMBINATION_SET):
+    # สำหรับโหมด Reaction จะใช้ FX, FY, FZ, ...
+    value_cols = REACTION_VALUE_COLS
+    group_cols = get_group_cols('Reaction')
+
+    # --- ขั้นตอนที่ 1-2: จัดค่าแรงเป็นเมทริกซ์ (ชิ้นส่วน x Load Case x ค่าแรง) ---
+    if case_matrix is None:
+        case_matrix = build_case_matrix_profiled(
+            df_load, group_cols, value_cols, profiler, 'Reaction', combination_set.cases
+        )
+    keys_df, values = case_matrix
+
+    # --- ขั้นตอนที่ 3: คำนวณ Load Combinations (Factor ที่ผู้ใช้กรอกคูณเฉพาะ FZ, MX, MY, MZ) ---
+    values = scale_case_values(values, pre_combo_factors, value_cols, REACTION_FACTOR_COLS, combination_set.cases)
+    names, coeffs = combination_set.coefficients(value_cols)
+    result_df = combine_profiled(keys_df, values, names, coeffs, value_cols, envelope, profiler, 'Reaction')
+
+    # --- ขั้นตอนที่ 4: รวมผลลัพธ์กับไฟล์พิกัด ---
+    # ไม่แก้ตารางพิกัดของผู้เรียก (หน้าเว็บและ Revision ก่อนหน้าใช้ตารางเดียวกันขณะงานเบื้องหลังทำงาน)
+    coords = df_coords.rename(columns={'UniqueName': 'Unique Name'})
+    coords_to_merge = coords[['Unique Name', 'X', 'Y', 'Z']].drop_duplicates(subset=['Unique Name'])
+    
+    with profiler.stage('merge', pipeline='Reaction', rows_in=len(result_df)) as record:
+        final_df = pd.merge(result_df, coords_to_merge, on='Unique Name', how='left')
+        record['rows_out'] = len(final_df)
+    if envelope:
+        return final_df[['Story', 'Unique Name', 'X', 'Y', 'Z'] + envelope_columns(value_cols)]
+
+    # --- ขั้นตอนที่ 5: จัดเรียงและจัดรูปแบบผลลัพธ์ ---
+    with profiler.stage('round', pipeline='Reaction', rows_in=len(final_df)):
+        final_df[value_cols] = final_df[value_cols].round(4)
+    # จัดเรียงคอลัมน์ใหม่เพื่อให้ดูง่าย
+    final_cols = ['Story', 'Unique Name', 'X', 'Y', 'Z', 'Output Case'] + value_cols
+    return final_df[final_cols]
+# --- <<<<<<<<<<<<<<<<<<<< สิ้นสุดฟังก์ชันใหม่ <<<<<<<<<<<<<<<<<<<< ---
+
+
+# --- Combination ที่ควบคุมและชิ้นส่วนวิกฤต (คำนวณจากเมทริกซ์โดยตรง ไม่ต้องสร้างตารางยาว) ---
+def compute_demand_metrics(combo_vals, value_cols, mode):
+    col = {val_col: combo_vals[:, j] for j, val_col in enumerate(value_cols)}
+    if mode == 'Reaction':
+        # ETABS: FZ บวก = แรงกดลงฐานราก, FZ ลบ = แรงถอน (Uplift) ฝั่งตรงข้ามคิดเป็น 0 (ไม่มีแรงกด/แรงถอน)
+        return {
+            'Compression': np.maximum(col['FZ'], 0.0),
+            'Uplift': np.maximum(-col['FZ'], 0.0),
+            'Shear': np.hypot(col['FX'], col['FY']),
+            'Moment': np.hypot(col['MX'], col['MY']),
+        }
+    return {
+        'Axial': np.abs(col['P']),
+        'Shear': np.hypot(col['V2'], col['V3']),
+        'Moment': np.hypot(col['M2'], col['M3']),
+    }
+
+
+def find_governing_combinations(keys_df, values, names, coeffs, value_cols, mode, profiler=NULL_PROFILER):
+    # หาค่าสูงสุดทีละ Combination เหมือน Envelope: หน่วยความจำขึ้นกับจำนวนชิ้นส่วนเท่านั้น
+    metric_names = list(compute_demand_metrics(np.zeros((0, len(value_cols))), value_cols, mode))
+    n_elements = len(keys_df)
+    demand = np.full((n_elements, len(metric_names)), -np.inf)
+    governing_idx = np.zeros((n_elements, len(metric_names)), dtype=np.int16)
+    for i in range(len(names)):
+        combo_vals = np.einsum('ekc,kc->ec', values, coeffs[i])
+        metrics = compute_demand_metrics(combo_vals, value_cols, mode)
+        combo_demand = np.stack([metrics[name] for name in metric_names], axis=1)
+        is_max = combo_demand > demand
+        np.copyto(demand, combo_demand, where=is_max)
+        governing_idx[is_max] = i
+        profiler.progress(i + 1, len(names))
+
+    names_arr = np.asarray(names, dtype=object)
+    metric_dfs = []
+    for m, metric in enumerate(metric_names):
+        # ค่าแรงอื่นที่เกิดพร้อมกันใน Combination ที่ควบคุม (เช่น M2/M3 ที่คู่กับ |P| สูงสุด)
+        concurrent = np.einsum('ekc,ekc->ec', values, coeffs[governing_idx[:, m]])
+        metric_df = keys_df.assign(Metric=metric, Demand=demand[:, m].round(4))
+        metric_df['Output Case'] = names_arr[governing_idx[:, m]]
+        metric_df[value_cols] = concurrent.round(4)
+        metric_dfs.append(metric_df)
+    return pd.concat(metric_dfs, ignore_index=True)
+
+
+def rank_critical_elements(governing_df, top_k=10, element_cols=None):
+    # เลือก k อันดับแรกของแต่ละ (Metric, Story) ด้วย argpartition แล้วเรียงเฉพาะ k แถวนั้น
+    # ชิ้นส่วนที่ไม่มีแรงตาม Metric นั้นเลย (Demand = 0 เช่นไม่มีแรงถอน) ไม่นับเป็นชิ้นส่วนวิกฤต
+    governing_df = governing_df[governing_df['Demand'].to_numpy() > 0]
+    if element_cols:
+        # 1 แถวต่อชิ้นส่วน: เก็บ Station/ตำแหน่งที่ Demand สูงสุด ชิ้นส่วนเดียวกันจึงไม่ซ้ำในอันดับ
+        element_codes = governing_df.groupby(
+            ['Metric'] + element_cols, sort=False, observed=True, dropna=False
+        ).ngroup().to_numpy()
+        order = np.lexsort((-governing_df['Demand'].to_numpy(), element_codes))
+        first = order[np.r_[True, np.diff(element_codes[order]) != 0]]
+        governing_df = governing_df.iloc[np.sort(first)]
+    demand = governing_df['Demand'].to_numpy()
+    group_codes = governing_df.groupby(['Metric', 'Story'], sort=False, observed=True).ngroup().to_numpy()
+    order = np.argsort(group_codes, kind='stable')
+    starts = np.flatnonzero(np.r_[True, np.diff(group_codes[order]) != 0])
+    ends = np.r_[starts[1:], len(order)]
+
+    selected, ranks = [], []
+    for start, end in zip(starts, ends):
+        rows = order[start:end]
+        if len(rows) > top_k:
+            rows = rows[np.argpartition(-demand[rows], top_k - 1)[:top_k]]
+        rows = rows[np.argsort(-demand[rows], kind='stable')]
+        selected.append(rows)
+        ranks.append(np.arange(1, len(rows) + 1))
+    if not selected:
+        return governing_df.iloc[:0].assign(Rank=pd.Series(dtype=np.int64))
+    critical_df = governing_df.iloc[np.concatenate(selected)].reset_index(drop=True)
+    critical_df.insert(0, 'Rank', np.concatenate(ranks))
+    return critical_df
+
+
+def calculate_governing_combinations(case_matrix, mode='Column', pre_combo_factors=None, top_k=10,
+                                     profiler=NULL_PROFILER, combination_set=STANDARD_COMBINATION_SET):
+    keys_df, values = case_matrix
+    if mode == 'Reaction':
+        value_cols = REACTION_VALUE_COLS
+        values = scale_case_values(values, pre_combo_factors, value_cols, REACTION_FACTOR_COLS, combination_set.cases)
+    else:
+        value_cols = MEMBER_VALUE_COLS
+    names, coeffs = combination_set.coefficients(value_cols)
+
+    with profiler.stage('governing', pipeline=mode, rows_in=len(keys_df)) as record:
+        governing_df = find_governing_combinations(keys_df, values, names, coeffs, value_cols, mode, profiler)
+        record['rows_out'] = len(governing_df)
+    with profiler.stage('rank', pipeline=mode, rows_in=len(governing_df)) as record:
+        critical_df = rank_critical_elements(governing_df, top_k, get_element_cols(mode))
+        record['rows_out'] = len(critical_df)
+    return governing_df, critical_df
+
+
+# --- คำนวณใหม่เฉพาะชิ้นส่วนที่เปลี่ยนระหว่าง Revision ของโมเดล (ผลลัพธ์ของชิ้นส่วนที่ไม่เปลี่ยนใช้ซ้ำ) ---
+def get_element_coords(keys_df, df_coords):
+    coords = df_coords.rename(columns={'UniqueName': 'Unique Name'})
+    coords = coords[['Unique Name', 'X', 'Y', 'Z']].drop_duplicates(subset=['Unique Name'])
+    return pd.merge(keys_df[['Unique Name']], coords, on='Unique Name', how='left')[['X', 'Y', 'Z']]
+
+
+def hash_element_rows(case_matrix, df_coords=None):
+    # แฮช 64 บิตของค่าแรงทุก Load Case ต่อชิ้นส่วน (+0.0 ทำให้ -0.0 กับ 0.0 ได้แฮชเดียวกัน)
+    # โหมด Reaction รวมพิกัดของจุดด้วย เพราะพิกัดอยู่ในตารางผลลัพธ์
+    keys_df, values = case_matrix
+    flat = pd.DataFrame(np.asarray(values, dtype=np.float64).reshape(len(keys_df), -1) + 0.0)
+    if df_coords is not None:
+        flat[['X', 'Y', 'Z']] = get_element_coords(keys_df, df_coords).to_numpy(dtype=np.float64) + 0.0
+    return pd.util.hash_pandas_object(flat, index=False).to_numpy()
+
+
+def diff_case_matrices(old_matrix, new_matrix, mode='Column', old_coords=None, new_coords=None,
+                       profiler=NULL_PROFILER):
+    # จับคู่ชิ้นส่วนของสอง Revision ด้วย group_cols แล้วเทียบแฮช
+    # คืนตาราง group_cols + Change + ตำแหน่งในเมทริกซ์เดิม/ใหม่ (-1 = ไม่มีใน Revision นั้น)
+    group_cols = get_group_cols(mode)
+    old_keys, new_keys = old_matrix[0], new_matrix[0]
+    with profiler.stage('diff', pipeline='Revision', rows_in=len(new_keys)) as record:
+        old_hash = hash_element_rows(old_matrix, old_coords)
+        new_hash = hash_element_rows(new_matrix, new_coords)
+        merged = pd.merge(
+            old_keys[group_cols].assign(old_pos=np.arange(len(old_keys))),
+            new_keys[group_cols].assign(new_pos=np.arange(len(new_keys))),
+            on=group_cols, how='outer', sort=False,
+        )
+        old_pos = merged['old_pos'].fillna(-1).to_numpy(dtype=np.int64)
+        new_pos = merged['new_pos'].fillna(-1).to_numpy(dtype=np.int64)
+        both = (old_pos >= 0) & (new_pos >= 0)
+        changed = both.copy()
+        changed[both] = old_hash[old_pos[both]] != new_hash[new_pos[both]]
+        change = np.select([old_pos < 0, new_pos < 0, changed], ['added', 'removed', 'changed'], 'unchanged')
+        diff_df = merged[group_cols].assign(
+            Change=pd.Categorical(change, categories=REVISION_CHANGES), old_pos=old_pos, new_pos=new_pos
+        )
+        record['rows_out'] = int((change != 'unchanged').sum())
+    return diff_df
+
+
+def count_revision_changes(diff_df):
+    return {change: int(count) for change, count in diff_df['Change'].value_counts(sort=False).items()}
+
+
+def calculate_incremental_combinations(previous_result, diff_df, new_matrix, mode='Column', envelope=False,
+                                       pre_combo_factors=None, df_coords=None, profiler=NULL_PROFILER,
+                                       combination_set=STANDARD_COMBINATION_SET):
+    # ได้ตารางเดียวกับการคำนวณทั้งไฟล์ แต่คำนวณ Combination เฉพาะชิ้นส่วนที่เพิ่มหรือเปลี่ยน
+    # previous_result ต้องเป็นผลของ Revision เดิมที่คำนวณด้วยชุด Combination, Factor และรูปแบบเดียวกัน
+    group_cols = get_group_cols(mode)
+    keys_df, values = new_matrix
+    change = diff_df['Change'].to_numpy()
+    old_pos, new_pos = diff_df['old_pos'].to_numpy(), diff_df['new_pos'].to_numpy()
+    pos = np.sort(new_pos[np.isin(change, ['added', 'changed'])])
+    subset = (keys_df.iloc[pos].reset_index(drop=True), values[pos])
+    if mode == 'Reaction':
+        new_rows = calculate_reaction_combinations(
+            None, df_coords, pre_combo_factors, envelope=envelope, case_matrix=subset, profiler=profiler,
+            combination_set=combination_set,
+        )
+        names = combination_set.coefficients(REACTION_VALUE_COLS)[0]
+    else:
+        new_rows = calculate_combinations(
+            None, mode=mode, envelope=envelope, case_matrix=subset, profiler=profiler,
+            combination_set=combination_set,
+        )
+        names = combination_set.coefficients(MEMBER_VALUE_COLS)[0]
+
+    # ตารางผลลัพธ์เรียงทีละ Combination แล้วตามลำดับชิ้นส่วนในเมทริกซ์ (Envelope: 1 แถวต่อชิ้นส่วน)
+    # จึงย้ายแถวเดิมไปตำแหน่งใหม่ด้วยดัชนีได้โดยตรง ไม่ต้อง merge ด้วยคีย์
+    n_blocks = 1 if envelope else len(names)
+    n_old, n_new = int((old_pos >= 0).sum()), len(keys_df)
+    if len(previous_result) != n_old * n_blocks:
+        raise ValueError("previous_result does not match the previous revision")
+    with profiler.stage('merge', pipeline='Revision', rows_in=len(previous_result)) as record:
+        old_to_new = np.full(n_old, -1, dtype=np.int64)
+        unchanged = change == 'unchanged'
+        old_to_new[old_pos[unchanged]] = new_pos[unchanged]
+        kept_src = np.flatnonzero(np.tile(old_to_new >= 0, n_blocks))
+        kept_dst = kept_src // max(n_old, 1) * n_new + old_to_new[kept_src % max(n_old, 1)]
+        new_dst = np.repeat(np.arange(n_blocks) * n_new, len(pos)) + np.tile(pos, n_blocks)
+
+        # รวมแถวเดิมกับแถวใหม่ครั้งเดียวแล้ว take ตามตำแหน่งปลายทาง (คอลัมน์ข้อความไม่ต้องแปลงเป็น object)
+        result_cols = new_rows.columns.drop(group_cols)
+        frames = [previous_result[result_cols], new_rows[result_cols]]
+        combined = pd.concat([frame for frame in frames if len(frame)] or frames[1:], ignore_index=True)
+        source = np.empty(n_new * n_blocks, dtype=np.int64)
+        source[kept_dst] = kept_src
+        source[new_dst] = len(previous_result) + np.arange(len(new_rows))
+        result_df = combined.take(source).reset_index(drop=True)
+
+        # ชนิดของคีย์ตามแถวที่คำนวณใหม่ (เช่น Unique Name หลัง merge พิกัดในโหมด Reaction)
+        dtype_source = new_rows if len(new_rows) else previous_result
+        element_keys = keys_df[group_cols].astype({col: dtype_source[col].dtype for col in group_cols})
+        element_keys = element_keys.iloc[np.tile(np.arange(n_new), n_blocks)].reset_index(drop=True)
+        result_df = pd.concat([element_keys, result_df], axis=1)
+        record['rows_out'] = len(result_df)
+    return result_df[list(new_rows.columns)]
+
+
+def report_revision_changes(diff_df, old_matrix, new_matrix, mode='Column', pre_combo_factors=None,
+                            profiler=NULL_PROFILER, combination_set=STANDARD_COMBINATION_SET):
+    # ค่า Demand ที่ควบคุมของชิ้นส่วนที่เพิ่ม/ลบ/เปลี่ยน ก่อนและหลังแก้ไข เรียงตามขนาดที่เปลี่ยน
+    group_cols = get_group_cols(mode)
+    touched = diff_df[diff_df['Change'].to_numpy() != 'unchanged']
+    sides = []
+    for (keys_df, values), pos_col, side in [(old_matrix, 'old_pos', 'Old'), (new_matrix, 'new_pos', 'New')]:
+        pos = touched[pos_col].to_numpy()
+        pos = np.sort(pos[pos >= 0])
+        governing_df, _ = calculate_governing_combinations(
+            (keys_df.iloc[pos].reset_index(drop=True), values[pos]), mode=mode,
+            pre_combo_factors=pre_combo_factors, top_k=1, profiler=profiler, combination_set=combination_set,
+        )
+        sides.append(governing_df[group_cols + ['Metric', 'Demand', 'Output Case']].rename(
+            columns={'Demand': f'{side} Demand', 'Output Case': f'{side} Output Case'}
+        ))
+
+    with profiler.stage('report', pipeline='Revision', rows_in=len(touched)) as record:
+        report_df = pd.merge(sides[0], sides[1], on=group_cols + ['Metric'], how='outer', sort=False)
+        report_df = pd.merge(touched[group_cols + ['Change']], report_df, on=group_cols, how='inner')
+        old_demand, new_demand = report_df['Old Demand'].to_numpy(), report_df['New Demand'].to_numpy()
+        delta = np.nan_to_num(new_demand) - np.nan_to_num(old_demand)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta_pct = np.where(np.abs(old_demand) > 0, delta / np.abs(old_demand) * 100, np.nan)
+        report_df['Delta'] = delta.round(4)
+        report_df['Delta %'] = delta_pct.round(2)
+        report_df = report_df.iloc[np.argsort(-np.abs(delta), kind='stable')].reset_index(drop=True)
+        record['rows_out'] = len(report_df)
+    return report_df[group_cols + [
+        'Change', 'Metric', 'Old Demand', 'New Demand', 'Delta', 'Delta %', 'Old Output Case', 'New Output Case'
+    ]]
+
+
+# --- ดัชนีของตารางผลลัพธ์ (กรองและแบ่งหน้าฝั่งเซิร์ฟเวอร์ ไม่ต้องส่งทั้งตารางไปยังเบราว์เซอร์) ---
+class ResultIndex:
+    def __init__(self, df, index_cols=RESULT_INDEX_COLS):
+        self.df = df
+        self.index_cols = [col for col in index_cols if col in df.columns]
+        self.values, self._codes, self._postings = {}, {}, {}
+        for col in self.index_cols:
+            # Inverted index: แถวของแต่ละค่าเรียงต่อกัน ค้นหาด้วยช่วง [bounds[c], bounds[c + 1])
+            codes, uniques = pd.factorize(df[col], sort=True)
+            order = np.argsort(codes, kind='stable')
+            bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+            self.values[col] = [str(value) for value in uniques]
+            self._codes[col] = codes
+            self._postings[col] = (order, bounds, {value: i for i, value in enumerate(self.values[col])})
+        # นับตารางที่ดัชนีอ้างอิงอยู่ด้วย ตารางค้างในหน่วยความจำตราบที่ดัชนียังอยู่ในแคช
+        self.nbytes = estimate_nbytes(df) + sum(codes.nbytes for codes in self._codes.values())
+        self.nbytes += sum(order.nbytes + bounds.nbytes for order, bounds, _ in self._postings.values())
+        self._last_query = None
+
+    def __len__(self):
+        return len(self.df)
+
+    def select(self, filters):
+        # filters = {คอลัมน์: [ค่า, ...]} รายการว่างหมายถึงไม่กรอง, คืน None เมื่อเลือกทุกแถว
+        key = tuple(sorted((col, tuple(values)) for col, values in filters.items() if values))
+        last_query = self._last_query
+        if last_query is not None and last_query[0] == key:
+            return last_query[1]
+        rows = None
+        if key:
+            mask = np.ones(len(self.df), dtype=bool)
+            for col, values in key:
+                order, bounds, lookup = self._postings[col]
+                col_mask = np.zeros(len(self.df), dtype=bool)
+                for code in {lookup[value] for value in values if value in lookup}:
+                    col_mask[order[bounds[code]:bounds[code + 1]]] = True
+                mask &= col_mask
+            rows = np.flatnonzero(mask)
+        self._last_query = (key, rows)
+        return rows
+
+    def count(self, filters):
+        rows = self.select(filters)
+        return len(self.df) if rows is None else len(rows)
+
+    def page(self, filters, page=0, page_size=500):
+        rows = self.select(filters)
+        start, end = page * page_size, (page + 1) * page_size
+        if rows is None:
+            return self.df.iloc[start:end]
+        return self.df.iloc[rows[start:end]]
+
+    def summary(self, filters):
+        # จำนวนค่าที่ไม่ซ้ำของแต่ละคอลัมน์ดัชนีในแถวที่กรองแล้ว
+        rows = self.select(filters)
+        if rows is None:
+            return {col: len(values) for col, values in self.values.items()}
+        return {col: len(np.unique(codes[rows])) for col, codes in self._codes.items()}
+
+
+# --- ส่วนของแคชผลลัพธ์ (ใช้ร่วมกันทุก Session, จำกัดขนาดและลบรายการที่ใช้ล่าสุดนานที่สุดก่อน) ---
+def estimate_nbytes(obj):
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return int(obj.memory_usage(deep=True).sum()) if isinstance(obj, pd.DataFrame) else int(obj.memory_usage(deep=True))
+    if hasattr(obj, 'nbytes'):
+        return int(obj.nbytes)
+    if isinstance(obj, (bytes, bytearray)):
+        return len(obj)
+    if isinstance(obj, io.BytesIO):
+        with obj.getbuffer() as view:
+            return view.nbytes
+    if isinstance(obj, (tuple, list)):
+        return sum(estimate_nbytes(item) for item in obj)
+    if isinstance(obj, dict):
+        return sum(estimate_nbytes(item) for item in obj.values())
+    return sys.getsizeof(obj)
+
+
+class ResultCache:
+    def __init__(self, max_bytes, max_entry_bytes=None):
+        self.max_bytes = max_bytes
+        # ค่าที่ใหญ่กว่านี้ไม่เก็บในแคช (ไม่ให้ผลลัพธ์ก้อนเดียวดันเมทริกซ์/ดัชนี/ไฟล์ดาวน์โหลดออกทั้งหมด)
+        self.max_entry_bytes = max_bytes // 4 if max_entry_bytes is None else max_entry_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key][0]
+
+    def put(self, key, value):
+        nbytes = estimate_nbytes(value)
+        if nbytes > self.max_entry_bytes:
+            return value
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, nbytes)
+            self.current_bytes += nbytes
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_bytes
+        return value
+
+    def get_or_compute(self, key, compute, profiler=NULL_PROFILER):
+        value = self.get(key)
+        if value is None:
+            value = self.put(key, compute())
+        else:
+            with profiler.stage('cache hit', pipeline=str(key[0])):
+                pass
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# --- คลังเมทริกซ์บนดิสก์ (เปิดโมเดลเดิมซ้ำข้าม Session/การรีสตาร์ทโดยไม่ต้องอ่านและ pivot ใหม่) ---
+def read_key_table(path):
+    # Parquet ไม่เก็บ Categorical ที่มีค่าเป็นตัวเลข จึงแปลงคอลัมน์คีย์กลับเหมือนตอนอ่านไฟล์
+    table = pd.read_parquet(path)
+    return table.astype({col: 'category' for col in table.columns if col in CATEGORICAL_COLS})
+
+
+class CaseMatrixStore:
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _entry_path(self, key):
+        return os.path.join(self.root, hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest())
+
+    def _entries(self):
+        # (เวลาใช้งานล่าสุด, ขนาด, path) ของทุกรายการที่เขียนเสร็จแล้ว
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            meta_path = os.path.join(path, 'meta.json')
+            if '.tmp' in name or not os.path.isfile(meta_path):
+                continue
+            try:
+                nbytes = sum(entry.stat().st_size for entry in os.scandir(path))
+                entries.append((os.path.getmtime(meta_path), nbytes, path))
+            except OSError:
+                continue
+        return entries
+
+    def get(self, key, profiler=NULL_PROFILER):
+        path = self._entry_path(key)
+        meta_path = os.path.join(path, 'meta.json')
+        if not os.path.isfile(meta_path):
+            return None
+        with profiler.stage('store load', pipeline='store') as record:
+            try:
+                with open(meta_path, encoding='utf-8') as f:
+                    meta = json.load(f)
+                if meta['key'] != repr(key):
+                    return None
+                # mmap: อ่านเฉพาะส่วนที่ใช้จริงจากดิสก์ และใช้ page cache ร่วมกันได้หลายโปรเซส
+                values = np.load(os.path.join(path, 'values.npy'), mmap_mode='r')
+                keys_df = read_key_table(os.path.join(path, 'keys.parquet'))
+                preview = read_key_table(os.path.join(path, 'preview.parquet'))
+                os.utime(meta_path)
+            except (OSError, ValueError, KeyError):
+                return None
+            record['rows_out'] = len(keys_df)
+        return (keys_df, values), dict(meta['info'], preview=preview, stored=True)
+
+    def put(self, key, case_matrix, info):
+        keys_df, values = case_matrix
+        if values.nbytes > self.max_bytes:
+            return
+        path = self._entry_path(key)
+        # เขียนลงโฟลเดอร์ชั่วคราวก่อน แล้วเปลี่ยนชื่อทีเดียว ผู้อ่านจึงไม่เห็นรายการที่เขียนไม่ครบ
+        tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        os.makedirs(tmp_path, exist_ok=True)
+        try:
+            np.save(os.path.join(tmp_path, 'values.npy'), np.ascontiguousarray(values))
+            keys_df.to_parquet(os.path.join(tmp_path, 'keys.parquet'), index=False)
+            info['preview'].to_parquet(os.path.join(tmp_path, 'preview.parquet'), index=False)
+            meta = {
+                'key': repr(key),
+                'created': time.time(),
+                'info': {name: value for name, value in info.items() if name not in ('preview', 'stored')},
+            }
+            with open(os.path.join(tmp_path, 'meta.json'), 'w', encoding='utf-8') as f:
+                json.dump(meta, f, default=float)
+            with self._lock:
+                if os.path.isdir(path):
+                    shutil.rmtree(tmp_path)
+                else:
+                    os.replace(tmp_path, path)
+                self._evict()
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        total = sum(nbytes for _, nbytes, _ in entries)
+        for _, nbytes, path in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= nbytes
+
+    @property
+    def current_bytes(self):
+        return sum(nbytes for _, nbytes, _ in self._entries())
+
+    def clear(self):
+        with self._lock:
+            for _, _, path in self._entries():
+                shutil.rmtree(path, ignore_errors=True)
+
+    def __len__(self):
+        return len(self._entries())
+
+
+def load_case_matrix(file, mode, downcast=False, cases=LOAD_CASES, store=None, store_key=None, profiler=NULL_PROFILER):
+    # คืน (case_matrix, info): เปิดจากคลังบนดิสก์ถ้ามี ไม่เช่นนั้นอ่านไฟล์, pivot แล้วเก็บลงคลัง
+    if store is not None:
+        stored = store.get(store_key, profiler)
+        if stored is not None:
+            return stored
+    df, stats = read_load_table(file, get_required_cols(mode), downcast=downcast, profiler=profiler, cases=cases)
+    case_matrix = build_case_matrix_profiled(df, get_group_cols(mode), get_value_cols(mode), profiler, mode, cases)
+    info = {
+        'read_stats': stats,
+        'cases_present': sorted(str(case) for case in df['Output Case'].unique()),
+        'preview': df.head(),
+        'stored': False,
+    }
+    if store is not None:
+        with profiler.stage('store save', pipeline='store', rows_in=len(case_matrix[0])):
+            store.put(store_key, case_matrix, info)
+    return case_matrix, info
+
+
+def hash_file(file, block_size=1 << 20):
+    digest = hashlib.blake2b(digest_size=16)
+    rewind(file)
+    for block in iter(lambda: file.read(block_size), b''):
+        digest.update(block)
+    rewind(file)
+    return digest.hexdigest()
+
+
+
+# --- งานเบื้องหลัง (คิวร่วมกันทั้งเซิร์ฟเวอร์ จำนวน worker จำกัด แสดงความคืบหน้าและยกเลิกได้) ---
+class JobCancelled(Exception):
+    pass
+
+
+class JobProfiler(Profiler):
+    def __init__(self, job, enabled=True, **context):
+        super().__init__(enabled, **context)
+        self.job = job
+
+    @contextmanager
+    def stage(self, name, pipeline='', rows_in=None):
+        self.job._enter_stage(name, pipeline, rows_in)
+        with super().stage(name, pipeline=pipeline, rows_in=rows_in) as record:
+            yield record
+
+    def progress(self, done, total=None):
+        self.job._report(done, total)
+
+
+class Job:
+    def __init__(self, job_id, key, compute, owner, label='', profile=False, context=None):
+        self.id = job_id
+        self.key = key
+        self.label = label
+        self.owners = {owner}
+        self.status = 'queued'
+        self.stage = ''
+        self.done = 0
+        self.total = None
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.profiler = JobProfiler(self, enabled=profile, **(context or {}))
+        self._compute = compute
+        self._cancel = threading.Event()
+
+    @property
+    def is_active(self):
+        return self.status in ('queued', 'running')
+
+    def _enter_stage(self, name, pipeline, rows_in):
+        if self._cancel.is_set():
+            raise JobCancelled()
+        self.stage = f"{pipeline} / {name}" if pipeline else name
+        self.done, self.total = 0, rows_in
+
+    def _report(self, done, total):
+        # จุดตรวจการยกเลิก: งานหยุดที่ขั้นตอนหรือ Combination ถัดไป
+        if self._cancel.is_set():
+            raise JobCancelled()
+        self.done, self.total = done, total
+
+
+class JobManager:
+    def __init__(self, max_workers=JOB_WORKERS, keep_finished=32):
+        self.max_workers = max_workers
+        self.keep_finished = keep_finished
+        self._jobs = OrderedDict()
+        self._queues = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Condition()
+        self._workers = [
+            threading.Thread(target=self._run_worker, name=f'load-combination-job-{i}', daemon=True)
+            for i in range(max_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, key, compute, owner, label='', profile=False, context=None):
+        # compute(profiler) ทำงานในเธรดเบื้องหลัง งานที่มีคีย์เดียวกันและยังไม่เสร็จจะใช้ร่วมกัน
+        # ค่าที่ compute คืนมา (ถ้าไม่ใช่ None) งานถือไว้จนกว่าผู้รอผลทุกคนจะรับไปด้วย take_result
+        with self._lock:
+            job = self._jobs.get(key)
+            # งานที่ถูกสั่งยกเลิกแต่ยังไม่หยุด จะไม่ถูกนำกลับมาใช้ซ้ำ
+            if job is not None and job.is_active and not job._cancel.is_set():
+                job.owners.add(owner)
+                return job
+            self._next_id += 1
+            job = Job(self._next_id, key, compute, owner, label, profile, context)
+            self._jobs[key] = job
+            self._jobs.move_to_end(key)
+            self._queues.setdefault(owner, deque()).append(job)
+            self._trim()
+            self._lock.notify()
+            return job
+
+    def get(self, key):
+        with self._lock:
+            return self._jobs.get(key)
+
+    def take_result(self, job, owner):
+        # ปล่อยผลลัพธ์ออกจากงานทันทีเมื่อผู้รอผลทุกคนรับไปแล้ว
+        with self._lock:
+            result = job.result
+            job.owners.discard(owner)
+            if not job.owners:
+                job.result = None
+            return result
+
+    def forget(self, job):
+        with self._lock:
+            if not job.is_active and self._jobs.get(job.key) is job:
+                del self._jobs[job.key]
+
+    def cancel(self, job, owner):
+        # ยกเลิกจริงเมื่อไม่มีผู้ใช้คนอื่นรอผลของงานเดียวกันอยู่
+        with self._lock:
+            job.owners.discard(owner)
+            if job.owners or not job.is_active:
+                return
+            job._cancel.set()
+            if job.status == 'queued':
+                job.status, job.finished = 'cancelled', time.time()
+
+    def counts(self):
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+        return {status: statuses.count(status) for status in ('queued', 'running')}
+
+    def _trim(self):
+        finished = [key for key, job in self._jobs.items() if not job.is_active]
+        for key in finished[:max(0, len(finished) - self.keep_finished)]:
+            del self._jobs[key]
+
+    def _next_job(self):
+        # สลับคิวของแต่ละผู้ใช้แบบ Round-robin ผู้ที่ส่งงานหลายชิ้นจึงไม่แย่ง worker ทั้งหมดไปจากคนอื่น
+        while self._queues:
+            owner, queue = next(iter(self._queues.items()))
+            job = queue.popleft()
+            if queue:
+                self._queues.move_to_end(owner)
+            else:
+                del self._queues[owner]
+            if job.status == 'queued':
+                return job
+        return None
+
+    def _run_worker(self):
+        while True:
+            with self._lock:
+                job = self._next_job()
+                while job is None:
+                    self._lock.wait()
+                    job = self._next_job()
+                job.status, job.started = 'running', time.time()
+            result, error, status = None, None, 'done'
+            try:
+                result = job._compute(job.profiler)
+            except JobCancelled:
+                status = 'cancelled'
+            except Exception as e:
+                error, status = str(e), 'failed'
+                logger.exception("job %s failed", job.label or job.id)
+            with self._lock:
+                job.result, job.error, job.status, job.finished = result, error, status, time.time()
+                job._compute = None
+                self._trim()
+
+
+# --- ส่วนของการเขียนไฟล์ผลลัพธ์ (เขียนทีละส่วน ไม่สร้างข้อความ CSV ทั้งไฟล์ในหน่วยความจำ) ---
+def get_output_file_name(file_name, output_format):
+    base_name = file_name[:-len('.csv')] if file_name.endswith('.csv') else file_name
+    return base_name + OUTPUT_FORMATS[output_format][0]
+
+
+def write_csv_chunks(df, stream, chunk_rows=CSV_CHUNK_ROWS):
+    text_stream = io.TextIOWrapper(stream, encoding='utf-8', newline='', write_through=True)
+    for start in range(0, max(len(df), 1), chunk_rows):
+        df.iloc[start:start + chunk_rows].to_csv(text_stream, index=False, header=(start == 0))
+    text_stream.flush()
+    text_stream.detach()
+
+
+def write_result(df, file, output_format='csv', entry_name='result.csv', chunk_rows=CSV_CHUNK_ROWS):
+    if output_format == 'csv':
+        write_csv_chunks(df, file, chunk_rows)
+    elif output_format == 'csv.gz':
+        with gzip.GzipFile(fileobj=file, mode='wb', compresslevel=6) as gz:
+            write_csv_chunks(df, gz, chunk_rows)
+    elif output_format == 'zip':
+        with zipfile.ZipFile(file, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+            entry_info = zipfile.ZipInfo(entry_name, date_time=time.localtime()[:6])
+            entry_info.compress_type = zipfile.ZIP_DEFLATED
+            with zf.open(entry_info, 'w', force_zip64=True) as entry:
+                write_csv_chunks(df, entry, chunk_rows)
+    elif output_format == 'parquet':
+        import_pyarrow()
+        df.to_parquet(file, index=False)
+    elif output_format == 'feather':
+        import_pyarrow()
+        df.reset_index(drop=True).to_feather(file)
+    else:
+        raise ValueError(f"Unknown output format: {output_format}")
+
+
+def serialize_result(df, output_format='csv', entry_name='result.csv'):
+    # คืนบัฟเฟอร์โดยตรง (ไม่คัดลอกเป็น bytes อีกชุด) ส่งให้ st.download_button ได้ทันที
+    buffer = io.BytesIO()
+    write_result(df, buffer, output_format, entry_name=entry_name)
+    buffer.seek(0)
+    return buffer